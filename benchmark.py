@@ -0,0 +1,189 @@
+"""Benchmarks of the overhead the wrapper classes add on top of nipype.
+
+Builds synthetic pipelines of PrimitiveSource, PyFunction2 and
+IdentityInterface units (no FSL needed) of different sizes and times the
+basic operations of NipypeWrapperUnit and NipypeWrapperPipeline. The results
+are written as JSON, so that they can be compared between versions:
+
+    python2 benchmark.py --sizes 10 100 1000 --output bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import nipype
+import nipype.interfaces.utility as util
+
+from nipype_wrapper_base import NipypeWrapperUnit as Unit
+from nipype_wrapper_base import NipypeWrapperPipeline as Pipeline
+from nipype_wrapper_interfaces import PrimitiveSource, PyFunction2
+
+
+class IdentityUnit(Unit):
+    interface = util.IdentityInterface(fields=['a'])
+    tag = "Benchmark"
+    instance_name_template = "ident"
+
+
+def make_unit_classes(n):
+    """Create n new Unit classes, to time the metaclass"""
+    return [type('BenchIdentity%d' % i, (Unit,),
+                {'interface': util.IdentityInterface(fields=['a', 'b']),
+                 'tag': 'Benchmark',
+                 'instance_name_template': 'bench'})
+            for i in xrange(n)]
+
+
+def make_units(n):
+    """A source, followed by a chain of alternating identity and function
+    units. Returns a list of (unit, name) pairs"""
+    units = [(PrimitiveSource(), 'src')]
+    for i in xrange(1, n):
+        if i % 2:
+            units.append((IdentityUnit(), 'ident%d' % i))
+        else:
+            units.append((PyFunction2(), 'func%d' % i))
+    return units
+
+
+def make_edges(units):
+    """Chain the units and additionally feed the source into every function
+    unit"""
+    out_ports = {IdentityUnit: 'a', PyFunction2: 'out_val1', PrimitiveSource: 'str_par'}
+    in_ports = {IdentityUnit: 'a', PyFunction2: 'in_val1'}
+
+    edges = []
+    for (src, src_name), (dst, dst_name) in zip(units[:-1], units[1:]):
+        edges.append((src_name, out_ports[type(src)], dst_name, in_ports[type(dst)]))
+        if isinstance(dst, PyFunction2):
+            edges.append(('src', 'str_par', dst_name, 'in_val2'))
+    return edges
+
+
+class Timer(object):
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.time() - self.start
+
+
+def run_size(n, workdir, run_max):
+    """Returns {benchmark name: seconds} for a pipeline of n units"""
+    results = {}
+
+    with Timer() as t:
+        make_unit_classes(n)
+    results['class_creation'] = t.seconds
+
+    ppl = Pipeline('bench%d' % n, base_dir=workdir)
+    # don't add the benchmark units to the user's timing history
+    ppl.record_timings = False
+    units = make_units(n)
+    with Timer() as t:
+        for unit, name in units:
+            ppl.add_unit(unit, name)
+    results['add_unit'] = t.seconds
+
+    edges = make_edges(units)
+    with Timer() as t:
+        for edge in edges:
+            ppl.connect(*edge)
+    results['connect'] = t.seconds
+
+    with Timer() as t:
+        for unit in ppl.units:
+            type(unit).get_in_ports()
+            type(unit).get_out_ports()
+    results['port_listing'] = t.seconds
+
+    fname = os.path.join(workdir, 'bench%d.json' % n)
+    with Timer() as t:
+        Pipeline.save(ppl, fname)
+    results['save'] = t.seconds
+
+    with Timer() as t:
+        loaded = Pipeline.load(fname)
+    results['load'] = t.seconds
+
+    if n <= run_max:
+        # the first run executes the (trivial) nodes, the second one finds
+        # all of them in nipype's cache: that's the overhead of a run, which
+        # has nothing to compute
+        with Timer() as t:
+            ppl.run()
+        results['first_run'] = t.seconds
+
+        with Timer() as t:
+            ppl.run()
+        results['cached_run'] = t.seconds
+
+    with Timer() as t:
+        for unit, name in units:
+            loaded.remove_unit(name)
+    results['remove_unit'] = t.seconds
+
+    return results
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+            help='numbers of units of the synthetic pipelines')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='repetitions per size; the best time is reported')
+    parser.add_argument('--run-max', type=int, default=1000,
+            help='largest pipeline, for which the runs are timed')
+    parser.add_argument('--output', help='JSON file for the results (default: stdout)')
+    args = parser.parse_args(argv)
+
+    results = []
+    for n in args.sizes:
+        best = {}
+        for i in xrange(args.repeat):
+            workdir = tempfile.mkdtemp(prefix='earlpipeline-bench')
+            try:
+                for name, seconds in run_size(n, workdir, args.run_max).items():
+                    best[name] = min(seconds, best.get(name, seconds))
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        for name, seconds in sorted(best.items()):
+            results.append({'size': n,
+                            'benchmark': name,
+                            'seconds': seconds,
+                            'seconds_per_unit': seconds / n})
+            sys.stderr.write('%6d units  %-15s %10.4f s\n' % (n, name, seconds))
+
+    report = {'version': git_version(),
+              'python': platform.python_version(),
+              'nipype': nipype.__version__,
+              'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
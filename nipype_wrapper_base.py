@@ -1,14 +1,38 @@
 """Base classes for nipype backend"""
 
+import nipype
 import nipype.pipeline.engine as pe
+from nipype import config as nipype_config
 from nipype.interfaces.utility import Function
 import nipype.interfaces.base as nibase
 import numpy as np
 
 from earlpipeline.backends import base
 
+from nipype_wrapper_plugins import CancellableMixin, CancellableMultiProcPlugin, JobQueuePlugin
+from nipype_wrapper_status import StatusDispatcher
+from nipype_wrapper_profile import PipelineProfile
+from nipype_wrapper_plan import TimingHistory, make_plan
+from nipype_wrapper_store import use_result_store
+from nipype_wrapper_scratch import IntermediateCleaner
+from nipype_wrapper_sweep import ParameterSweep
+from nipype_wrapper_paths import user_temp_dir
+
+import os
+import sys
+import json
+import uuid
+import logging
+import multiprocessing
+import Queue
 import pickle
+import tempfile
+import threading
+import traceback
 from abc import ABCMeta
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
 
 # Some default class variables to be set upon the NipypeWrapperUnit class
 # creation. These defaults are applied via the metaclass
@@ -19,9 +43,70 @@ base_defaults = {
         # redirection
         'redirected_ports_number': None,
         'redirect_in_ports': False,
-        'redirect_out_ports': False
+        'redirect_out_ports': False,
+
+        # resource hints for the scheduler, e.g. {'mem_gb': 4, 'n_procs': 2}
+        'resources': {},
+
+        # whether the results of the unit are shared via the result store of
+        # the pipeline (see NipypeWrapperPipeline.result_store). Disabled for
+        # units with side effects (e.g. sinks) and for cheap units
+        'use_result_store': True,
+
+        # whether the outputs of the unit may be the paths it got as inputs,
+        # which keeps the upstream outputs alive while intermediates are
+        # cleaned up (see NipypeWrapperPipeline.cleanup_intermediates)
+        'passes_through_files': False
         }
 
+# Execution modes of NipypeWrapperPipeline. Every mode maps to a nipype plugin
+# (either a name or a plugin class) and the default plugin arguments, which
+# can be overridden by NipypeWrapperPipeline.set_execution_mode. There is no
+# thread pool mode on purpose: nipype changes the working directory of the
+# whole process while running a node, and FSL interfaces derive their output
+# paths from it, so nodes running in threads would write into each other's
+# directories. For the same reason, only the modes running the nodes in
+# other processes can run in the background (see 'in_process_modes' and
+# NipypeWrapperPipeline.run_async)
+execution_modes = {
+        # run nodes one by one in the server process
+        'serial': ('Linear', {}),
+
+        # run nodes in a pool of 'n_procs' worker processes
+        'processes': (CancellableMultiProcPlugin, {}),
+
+        # like 'processes', but schedule the nodes by their memory and CPU
+        # requirements, taken from the 'resources' hints of the units. The
+        # overall budget is set via the 'n_procs' and 'memory_gb' arguments
+        'resources': (CancellableMultiProcPlugin, {'scheduler': 'mem_thread'}),
+
+        # submit the nodes to a shared job queue, served by workers on any
+        # number of hosts (see nipype_wrapper_jobqueue). Arguments: 'queue',
+        # 'max_tries' and 'local_workers'
+        'jobqueue': (JobQueuePlugin, {})
+        }
+
+# Execution modes, which run the nodes in the process of the pipeline
+in_process_modes = set(['serial'])
+
+# All Unit classes wrapping an interface, by class name. Used to restore the
+# units when loading a pipeline file
+unit_registry = {}
+
+# Pipeline file format (see NipypeWrapperPipeline.save)
+pipeline_format = 'earlpipeline-nipype'
+pipeline_format_version = 1
+
+# Functions upgrading a loaded pipeline state from the given version to the
+# next one, i.e. {1: upgrade_1_to_2}
+pipeline_migrations = {}
+
+# Cached port lists of the unit classes, to list the unit types without
+# creating their interfaces (see LazyInterface)
+unit_types_cache_file = os.path.join(tempfile.gettempdir(), 'earlpipeline',
+        'unit_types.json')
+_unit_types_cache = None
+
 # String conventions
 redir_port_template = "slot_%s" # 0: port number
 redir_parameter_template = "%s_%s" # 0: port name; 1: port type (in/out)
@@ -43,6 +128,8 @@ class NipypeWrapperUnitMeta(ABCMeta):
 
         # do additional stuff only if interface variable is specified
         if dct.has_key('interface'):
+            unit_registry[name] = cls
+
             # set the defaults
             for k, v in base_defaults.items():
                 if not dct.has_key(k):
@@ -54,37 +141,23 @@ class NipypeWrapperUnitMeta(ABCMeta):
                 # add user supplied hidden ports, if given
                 cls.hidden_in_ports += dct['hidden_in_ports']
 
-            # check if the nipype interface is supplied, but not for the base class
-            interface = dct['interface']
-            #if not interface:
-                #raise Exception("Please, specify nipype interface as a class attribute")
-            if not isinstance(interface, nibase.Interface):
-                raise Exception("Unknown interface type passed: %s, expected an instance of nipype.interfaces.base.Interface" % type(interface))
-
             # get a list of parameter objects
             parameter_names = []
             for attrname, attrvalue in dct.iteritems():
                 if isinstance(attrvalue, base.Parameter):
                     parameter_names.append(attrname)
-
-            
-            # check if all parameters correspond to valid nipype inputs
-            if cls.check_in_ports:
-                input_traits = interface.inputs.trait_get()
-                for p_name in parameter_names:
-                    if not input_traits.has_key(p_name):
-                        raise Exception("Passed parameter %s doesn't correspond to any input port of interface %s" % (p_name, repr(interface)))
+            cls._parameter_names = parameter_names
 
             # Add parameter names to a list of excluded ports (they're not used
             # for dynamic data transfer)
             #cls.hidden_in_ports += parameter_names
 
-            # if a special input attribute "logger_name" is present in the
-            # interface and not a parameter, add it to the list of hidden ports
-            logger_name = 'logger_name'
-            if (interface.inputs.trait_get().has_key(logger_name)) \
-                    and (not logger_name in parameter_names):
-                cls.hidden_in_ports.append(logger_name)
+            # lazy interfaces are checked once they are created
+            interface = dct['interface']
+            if isinstance(interface, LazyInterface):
+                interface.owner = cls
+            else:
+                cls._check_interface(interface)
 
             ####################
             # Port redirection #
@@ -113,6 +186,9 @@ class NipypeWrapperUnitMeta(ABCMeta):
                 cls.redirected_out_ports = []
                 cls.redirected_in_ports = []
 
+                # parameter name -> (port type, port name)
+                cls.redirection_parameters = {}
+
                 for port_type, port_num in port_nums.items():
                     for j in range(port_num):
                         # create a port name
@@ -122,7 +198,236 @@ class NipypeWrapperUnitMeta(ABCMeta):
                         # create a corresponding parameter
                         par_name = redir_parameter_template % (port_name, port_type)
                         setattr(cls, par_name, base.Parameter(par_name, 'text', str, port_name))
+                        cls.redirection_parameters[par_name] = (port_type, port_name)
+
+        # the port lists are computed on the first request (see 'get_ports')
+        cls._port_cache = None
+        cls._port_cache_invalidated = False
+
+    def _check_interface(cls, interface):
+        """Check the nipype interface of the class against its parameters"""
+        # check if the nipype interface is supplied, but not for the base class
+        #if not interface:
+            #raise Exception("Please, specify nipype interface as a class attribute")
+        if not isinstance(interface, nibase.Interface):
+            raise Exception("Unknown interface type passed: %s, expected an instance of nipype.interfaces.base.Interface" % type(interface))
+
+        # check if all parameters correspond to valid nipype inputs
+        if cls.check_in_ports:
+            input_traits = interface.inputs.trait_get()
+            for p_name in cls._parameter_names:
+                if not input_traits.has_key(p_name):
+                    raise Exception("Passed parameter %s doesn't correspond to any input port of interface %s" % (p_name, repr(interface)))
+
+        # if a special input attribute "logger_name" is present in the
+        # interface and not a parameter, add it to the list of hidden ports
+        logger_name = 'logger_name'
+        if (interface.inputs.trait_get().has_key(logger_name)) \
+                and (not logger_name in cls._parameter_names):
+            cls.hidden_in_ports.append(logger_name)
+
+    def _raw_interface(cls):
+        """The 'interface' class attribute, without creating it if it is
+        lazy"""
+        for klass in cls.__mro__:
+            if klass.__dict__.has_key('interface'):
+                return klass.__dict__['interface']
+        return None
+
+    def get_ports(cls):
+        """Returns a dict {'in': (...), 'out': (...)} with the names of the
+        visible input and output ports of the Unit class. The lists are
+        obtained from the nipype interface only once per class, since building
+        the traits objects is expensive. For lazy interfaces, which are not
+        created yet, the lists are taken from the unit types cache file"""
+        # look up the class' own dict, not to pick up the cache of a parent
+        cache = cls.__dict__.get('_port_cache')
+        if cache is None:
+            interface = cls._raw_interface()
+            if isinstance(interface, LazyInterface) and not interface.created:
+                cache = _get_cached_unit_type(cls)
+
+            if cache is None:
+                cache = {'in': tuple(cls._compute_in_ports()),
+                        'out': tuple(cls._compute_out_ports())}
+
+                # ports of a mutated interface are not valid for the next
+                # process
+                if not cls.__dict__.get('_port_cache_invalidated'):
+                    _put_cached_unit_type(cls, cache)
+
+            cls._port_cache = cache
+
+        return cache
+
+    def invalidate_port_cache(cls):
+        """Drop the cached port lists. Should be called after the interface
+        of the class was mutated dynamically (e.g. traits were added)"""
+        cls._port_cache = None
+        cls._port_cache_invalidated = True
+
+    def get_info(cls):
+        """Returns the metadata of the Unit class, which is needed to list
+        it in the GUI. Doesn't create lazy interfaces, if their ports are
+        cached"""
+        parameters = set()
+        for klass in cls.__mro__:
+            for attrname, attrvalue in klass.__dict__.items():
+                if isinstance(attrvalue, base.Parameter):
+                    parameters.add(attrname)
+
+        ports = cls.get_ports()
+        return {'name': cls.__name__,
+                'tag': getattr(cls, 'tag', None),
+                'in_ports': list(ports['in']),
+                'out_ports': list(ports['out']),
+                'parameters': sorted(parameters)}
+
+    def _compute_in_ports(cls):
+        #if isinstance(cls.interface, Function):
+            #input_names = cls.interface._input_names
+        if isinstance(cls.interface, nibase.Interface):
+            input_names = cls.interface.inputs.trait_get().keys()
+        else:
+            raise Exception("Not implemented for interfaces of type %s" % type(cls.interface))
 
+        if hasattr(cls, 'redirected_in_ports'):
+            input_names += cls.redirected_in_ports
+
+        # don't show hidden ports
+        return [name for name in input_names if not name in cls.hidden_in_ports]
+
+    def _compute_out_ports(cls):
+        if isinstance(cls.interface, nibase.Interface):
+            # Try to obtain output ports from the secret `_outputs` method
+            try:
+                output_names = cls.interface._outputs().trait_get().keys()
+                if hasattr(cls, 'redirected_out_ports'):
+                    output_names += cls.redirected_out_ports
+                return output_names
+            except:
+                raise Exception("Couldn't obtain output ports from %s"%cls.interface.output_spec.__name__)
+        else:
+            raise Exception("Not implemented for interfaces of type %s" % type(cls.interface))
+
+
+
+class LazyInterface(object):
+    """Stands in for the 'interface' class attribute of a Unit, to postpone
+    importing the nipype interface modules and creating the interface until
+    the interface is actually needed, i.e. when a unit of this type is
+    initialized. 'factory' is a function without arguments, returning the
+    interface instance:
+
+        def make_bet():
+            import nipype.interfaces.fsl as fsl
+            return fsl.BET()
+
+        class BrainExtractor(Unit):
+            interface = LazyInterface(make_bet)
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+
+        # the Unit class, set by the metaclass
+        self.owner = None
+
+        self._interface = None
+        self._lock = threading.Lock()
+
+    @property
+    def created(self):
+        return self._interface is not None
+
+    def get(self):
+        with self._lock:
+            if self._interface is None:
+                interface = self.factory()
+                if self.owner is not None:
+                    self.owner._check_interface(interface)
+                self._interface = interface
+        return self._interface
+
+    def __get__(self, instance, owner):
+        return self.get()
+
+
+# modules, besides the one of the unit class, which the ports of a unit type
+# depend on: the port logic here and the interfaces the factories create
+_unit_type_dependencies = ['nipype_wrapper_base.py',
+                           'nipype_wrapper_custom_interfaces.py']
+
+def _source_stamp(fname):
+    if fname.endswith('.pyc'):
+        fname = fname[:-1]
+    st = os.stat(fname)
+    return '%s:%s' % (st.st_mtime, st.st_size)
+
+
+def _unit_type_key(cls):
+    """Key of the class in the unit types cache. It changes whenever the
+    module defining the class, one of the '_unit_type_dependencies' or the
+    nipype version changes"""
+    module_file = getattr(sys.modules.get(cls.__module__), '__file__', None)
+    if not module_file:
+        return None
+
+    stamps = [_source_stamp(module_file)]
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    for fname in _unit_type_dependencies:
+        fname = os.path.join(backend_dir, fname)
+        if os.path.exists(fname):
+            stamps.append(_source_stamp(fname))
+
+    return '%s.%s:%s:%s' % (cls.__module__, cls.__name__, ':'.join(stamps),
+            nipype.__version__)
+
+
+def _load_unit_types_cache():
+    global _unit_types_cache
+    if _unit_types_cache is None:
+        _unit_types_cache = {}
+        try:
+            with open(unit_types_cache_file) as f:
+                _unit_types_cache = json.load(f)
+        except (IOError, ValueError):
+            pass
+    return _unit_types_cache
+
+
+def _get_cached_unit_type(cls):
+    entry = _load_unit_types_cache().get(_unit_type_key(cls))
+    if entry is None:
+        return None
+    return {'in': tuple(str(port) for port in entry['in']),
+            'out': tuple(str(port) for port in entry['out'])}
+
+
+def _put_cached_unit_type(cls, ports):
+    # only classes with lazy interfaces go through the cache
+    if not isinstance(cls._raw_interface(), LazyInterface):
+        return
+
+    key = _unit_type_key(cls)
+    if key is None:
+        return
+
+    cache = _load_unit_types_cache()
+    if cache.get(key) == {'in': list(ports['in']), 'out': list(ports['out'])}:
+        return
+    cache[key] = {'in': list(ports['in']), 'out': list(ports['out'])}
+    try:
+        dirname = os.path.dirname(unit_types_cache_file)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_fname = '%s.%d.tmp' % (unit_types_cache_file, os.getpid())
+        with open(tmp_fname, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmp_fname, unit_types_cache_file)
+    except (IOError, OSError):
+        # the cache is an optimization only
+        pass
 
 
 class NipypeWrapperUnit(base.GenericUnit):
@@ -135,8 +440,9 @@ class NipypeWrapperUnit(base.GenericUnit):
     
     Special class attributes:
         
-        interface (mandatory): nipype.interfaces.Interface instance
-            A nipype interface that should be wrapped.
+        interface (mandatory): nipype.interfaces.Interface or LazyInterface
+            A nipype interface that should be wrapped. Use LazyInterface to
+            create it only when a unit of this type is initialized.
         tag: string
             Specifies the name of the sub-menu where this unit will be put by
             the GUI (e.g. "Sources")
@@ -146,6 +452,19 @@ class NipypeWrapperUnit(base.GenericUnit):
         hidden_in_ports: list of string
             List of names of input traits of the nipype interface, that
             shouldn't be exposed as input ports.
+        resources: {'mem_gb': float, 'n_procs': int}
+            Estimated memory and number of threads a single node of this unit
+            needs. Used by the 'resources' execution mode of the pipeline to
+            decide how many nodes may run in parallel.
+        use_result_store: bool
+            Whether the results of the unit are shared with other pipelines
+            via the result store of the pipeline. Should be False for units
+            with side effects. Defaults to True.
+        passes_through_files: bool
+            Whether the outputs of the unit may be paths it received as
+            inputs. Keeps the upstream outputs from being cleaned up too early
+            (see NipypeWrapperPipeline.cleanup_intermediates). Defaults to
+            False.
         redirected_ports_number: {'in': int, 'out': int}
             Numbers of automatically created input and output ports (slots) for
             redirection. Along with each port, a parameter with the same name
@@ -163,16 +482,22 @@ class NipypeWrapperUnit(base.GenericUnit):
     def __init__(self):
         super(NipypeWrapperUnit, self).__init__()
         self._pipeline = None
+
+        # resolved port redirections: (port type, port name) -> nipype port
+        self._redirections = {}
+
+        # parameter values collected by 'set_parameters'
+        self._pending_parameters = None
+
+        # node counts during a run (see StatusDispatcher)
+        self.progress = None
         if not hasattr(self, 'node_attrs'):
             self.node_attrs = {}
 
     def initialize(self, name):
         """Initializes underlying nipype.Node instance. This method is called
         by the Pipeline when the new unit instance is added"""
-        if not hasattr(self, 'node_type'):
-            self._node = pe.Node(self.interface, name, **self.node_attrs)
-        else:
-            self._node = self.node_type(interface=self.interface, name=name, **self.node_attrs)
+        self._node = self.create_node(name)
 
         # explicitly initialize parameters by invoking __get__ of the Parameter
         # descriptor (which is called inside by the getter method of the
@@ -185,6 +510,24 @@ class NipypeWrapperUnit(base.GenericUnit):
             self._node.inputs.logger_name = self.logger.name
 
 
+    def create_node(self, name, node_type=None, **kwargs):
+        """Returns a new nipype node for the unit's interface. The node type
+        defaults to the 'node_type' class attribute or pe.Node, the keyword
+        arguments are added to the 'node_attrs'"""
+        node_attrs = dict(self.node_attrs)
+        node_attrs.update(self.resources)
+        node_attrs.update(kwargs)
+
+        if node_type is None:
+            node_type = getattr(self, 'node_type', pe.Node)
+
+        return node_type(interface=self.interface, name=name, **node_attrs)
+
+    def prepare_run(self):
+        """Called by the pipeline before every run, after the graph is
+        final. Units can adjust their nodes to the graph here"""
+        pass
+
     @property
     def name(self):
         return self._node.name
@@ -198,32 +541,11 @@ class NipypeWrapperUnit(base.GenericUnit):
 
     @classmethod
     def get_in_ports(cls):
-        #if isinstance(cls.interface, Function):
-            #input_names = cls.interface._input_names
-        if isinstance(cls.interface, nibase.Interface):
-            input_names = cls.interface.inputs.trait_get().keys()
-        else:
-            raise Exception("Not implemented for interfaces of type %s" % type(cls.interface))
-
-        if hasattr(cls, 'redirected_in_ports'):
-            input_names += cls.redirected_in_ports
-
-        # don't show hidden ports
-        return [name for name in input_names if not name in cls.hidden_in_ports]
+        return cls.get_ports()['in']
 
     @classmethod
     def get_out_ports(cls):
-        if isinstance(cls.interface, nibase.Interface):
-            # Try to obtain output ports from the secret `_outputs` method
-            try:
-                output_names = cls.interface._outputs().trait_get().keys()
-                if hasattr(cls, 'redirected_out_ports'):
-                    output_names += cls.redirected_out_ports
-                return output_names
-            except:
-                raise Exception("Couldn't obtain output ports from %s"%cls.interface.output_spec.__name__)
-        else:
-            raise Exception("Not implemented for interfaces of type %s" % type(cls.interface))
+        return cls.get_ports()['out']
 
     def get_parameter(self, name):
         # if it a static predefined nipype port, get it the normal way
@@ -237,7 +559,119 @@ class NipypeWrapperUnit(base.GenericUnit):
                 raise AttributeError("Nipype node %s doesn't have parameter named %s" % (self._node.name, name))
 
     def set_parameter(self, name, value):
-        self._node.inputs.set(**{name: value})
+        if self._pending_parameters is not None:
+            # inside 'set_parameters': applied together with the others
+            self._pending_parameters[name] = value
+            return
+
+        self._apply_parameters({name: value})
+
+    def set_parameters(self, values):
+        """Set several parameters ({name: value}) at once. The values are
+        converted by the Parameter descriptors as with attribute assignment,
+        but the nipype inputs are updated in a single call, and the side
+        effects of the changes (see '_after_set_parameters') happen only
+        once. If any of the values is invalid, none of them is set"""
+        self._pending_parameters = {}
+        try:
+            for name, value in values.items():
+                if isinstance(getattr(type(self), name, None), base.Parameter):
+                    setattr(self, name, value)
+                else:
+                    self._pending_parameters[name] = value
+            pending = self._pending_parameters
+        finally:
+            self._pending_parameters = None
+
+        self._apply_parameters(pending)
+
+    def _apply_parameters(self, values):
+        inputs = self._node.inputs
+        # read like 'get_parameter' does, since the dynamic ports (e.g. the
+        # slots of a DataSink) are no attributes of the inputs
+        old_values = {}
+        for name in values:
+            try:
+                old_values[name] = self.get_parameter(name)
+            except AttributeError:
+                pass
+        iterables = self._node.iterables
+        try:
+            inputs.set(**values)
+            self._after_set_parameters(values)
+        except Exception:
+            self._restore_parameters(values, old_values, iterables)
+            raise
+
+        # let the pipeline know, that this unit has to be re-run
+        if self._pipeline:
+            self._pipeline._mark_dirty(self.name)
+
+    def _restore_parameters(self, values, old_values, iterables):
+        """Undo a failed '_apply_parameters': the inputs get their old
+        values back, the ones which didn't exist before are removed again,
+        and the redirections and iterables are put back in place"""
+        inputs = self._node.inputs
+        inputs.set(**old_values)
+        for name in values:
+            if name not in old_values:
+                inputs.remove_trait(name)
+                inputs.__dict__.pop(name, None)
+                getattr(inputs, '_outputs', {}).pop(name, None)
+
+        redirection_parameters = getattr(self, 'redirection_parameters', {})
+        for name, value in old_values.items():
+            if name in redirection_parameters:
+                self._update_redirection(name, value)
+
+        self._node.iterables = iterables
+
+    def _after_set_parameters(self, values):
+        """Called once the parameters 'values' ({name: value}) have been
+        set. Overload it for side effects of parameter changes"""
+        redirection_parameters = getattr(self, 'redirection_parameters', {})
+        for name, value in values.items():
+            if name in redirection_parameters:
+                self._update_redirection(name, value)
+
+    def _update_redirection(self, par_name, nipype_port):
+        """Keep the redirection map up to date and move the existing
+        connections of the redirected port to the new nipype port"""
+        port_type, port_name = self.redirection_parameters[par_name]
+        old_nipype_port = self._redirections.get((port_type, port_name))
+        self._redirections[(port_type, port_name)] = nipype_port
+
+        if self._pipeline and old_nipype_port is not None \
+                and old_nipype_port != nipype_port:
+            try:
+                self._pipeline._rewire(self.name, port_type, port_name,
+                        old_nipype_port, nipype_port)
+            except Exception:
+                # the connections stayed on the old port
+                self._redirections[(port_type, port_name)] = old_nipype_port
+                raise
+
+    def get_redirection(self, port_type, port_name):
+        """Returns the name of the nipype port, which the redirected port
+        'port_name' of type 'in' or 'out' currently points to"""
+        key = (port_type, port_name)
+        if not self._redirections.has_key(key):
+            self._redirections[key] = self.get_parameter(
+                    redir_parameter_template % (port_name, port_type))
+        return self._redirections[key]
+
+    def pins_upstream(self):
+        """Whether the unit references the files of its inputs after it
+        has finished, so that the outputs of the upstream units must not be
+        cleaned up (see NipypeWrapperPipeline.cleanup_intermediates)"""
+        return False
+
+    def get_shards(self):
+        """Units with large iterables can split them into shards, which are
+        then executed one after another, each in a separate workflow run (see
+        NipypeWrapperPipeline.run). Returns a list of the iterables for every
+        shard, or None if the unit is not sharded"""
+        return None
 
 
 
@@ -250,6 +684,76 @@ class NipypeWrapperPipeline(base.GenericPipeline):
         self._units = {} # name:Unit()
         self._edges = {} # id:Edge()
 
+        # adjacency index: unit name -> {id: Edge()}
+        self._in_edges = {}
+        self._out_edges = {}
+
+        # units and edges queued by the current batch (see 'batch')
+        self._batch = None
+
+        # functions f(unit_name, status), called on every status change
+        self._status_listeners = []
+
+        # how often (in seconds) the unit statuses are updated during a run
+        self.status_interval = 0.5
+        self._dispatcher = None
+
+        # (shard number, number of shards) of a sharded run in progress
+        self.shard_progress = None
+
+        # unique id of the current (or last) run
+        self.run_id = None
+
+        # runtime statistics of the last run (see PipelineProfile). Memory
+        # and CPU usage are only recorded with 'profile_resources' enabled,
+        # since nipype's resource monitor has its own overhead
+        self.profile = None
+        self.profile_resources = False
+
+        # whether the per-unit timings of every run are added to the timing
+        # history, which the run time estimates of 'plan' are based on
+        self.record_timings = True
+
+        # a ResultStore shared with other pipelines, which is consulted
+        # before running any node of the units with 'use_result_store'
+        self.result_store = None
+
+        # working directory policy. With 'cleanup_intermediates', the
+        # outputs of a node are deleted during the run as soon as all nodes
+        # consuming them have finished, except for the 'pinned_units'. The
+        # units with deleted outputs, and everything downstream of them, are
+        # re-run by the next run. See IntermediateCleaner and
+        # 'set_scratch_dir'
+        self.cleanup_intermediates = False
+        self.pinned_units = set()
+        self.cleaner = None
+
+        # only one run of a pipeline at a time. The handle is set if the run
+        # was started via 'run_async'
+        self._run_lock = threading.Lock()
+        self._run_handle = None
+
+        # see 'execution_modes'
+        self.execution_mode = 'serial'
+        self.plugin_args = {}
+
+        # names of the units, which were changed since the last successful
+        # run. Those and their downstream units are the only ones that are
+        # actually re-executed, everything else is taken from nipype's cache
+        self._dirty = set()
+        self._has_run = False
+
+        # nipype can reuse the results of the previous runs only if the
+        # workflow has a persistent working directory. Without a base_dir,
+        # the pipeline gets a directory of its own (per user and pipeline
+        # object, as pipelines of the same name must not share it). It is
+        # not removed with the pipeline, as it holds the results of the last
+        # run, but it is never reused either: pass base_dir to reuse the
+        # results across sessions
+        self._workdir_name = '%s-%s' % (name, uuid.uuid4().hex[:8])
+        if not self._workflow.base_dir:
+            self._workflow.base_dir = user_temp_dir(self._workdir_name)
+
     @property
     def name(self):
         return self._workflow.name
@@ -266,35 +770,120 @@ class NipypeWrapperPipeline(base.GenericPipeline):
         return self._units[unit_name]
 
     def add_unit(self, unit, unit_name, *args, **kwargs):
-        self._units[unit_name] = unit
+        self._register_unit(unit, unit_name, *args, **kwargs)
 
+        if self._batch is not None:
+            self._batch['units'].append(unit)
+        else:
+            self._workflow.add_nodes([unit._node])
+
+    def add_units(self, units):
+        """Add a list of (unit, unit_name) pairs in a single batch"""
+        with self.batch():
+            for unit, unit_name in units:
+                self.add_unit(unit, unit_name)
+
+    def connect_many(self, edges):
+        """Make a list of (src_name, src_port, dest_name, dest_port)
+        connections in a single batch. Returns the list of created edges"""
+        with self.batch():
+            return [self.connect(*edge) for edge in edges]
+
+    @contextmanager
+    def batch(self):
+        """Context manager grouping several 'add_unit' and 'connect' calls
+        into one transaction. The nodes and connections are passed over to
+        the nipype workflow only once, upon leaving the block, so that the
+        workflow graph is validated only once. If anything fails, either
+        inside the block or while committing, all the units and edges added
+        in the block are removed again. Nested batches are merged into the
+        outermost one.
+
+        Removing units or edges is not allowed inside a batch.
+
+            with ppl.batch():
+                ppl.add_unit(BrainExtractor(), 'bet1')
+                ppl.add_unit(DTIFitter(), 'dtifit1')
+                ppl.connect('bet1', 'mask_file', 'dtifit1', 'mask')
+        """
+        if self._batch is not None:
+            yield self
+            return
+
+        self._batch = {'units': [], 'edges': []}
+        try:
+            yield self
+            self._commit_batch()
+        except:
+            self._rollback_batch()
+            raise
+        finally:
+            self._batch = None
+
+    def _commit_batch(self):
+        pending = self._batch
+        self._workflow.add_nodes([unit._node for unit in pending['units']])
+        self._connect_edges(pending['edges'])
+
+    def _rollback_batch(self):
+        pending = self._batch
+        for edge in pending['edges']:
+            if self._edges.has_key(edge.id):
+                self._remove_edge(edge)
+
+        # networkx ignores the nodes which were not added yet
+        self._workflow.remove_nodes([unit._node for unit in pending['units']])
+        for unit in pending['units']:
+            unit_name = unit.name
+            del self._units[unit_name]
+            del self._in_edges[unit_name]
+            del self._out_edges[unit_name]
+            self._dirty.discard(unit_name)
+            unit._pipeline = None
+
+    def _check_not_in_batch(self, action):
+        if self._batch is not None:
+            raise Exception("Cannot %s inside a batch" % action)
+
+    def _register_unit(self, unit, unit_name, *args, **kwargs):
+        """Initialize the unit and make it a part of the pipeline, without
+        adding its node to the workflow yet"""
         if unit._pipeline:
             raise Exception("Unit '%s' already belongs to pipeline '%s'" % (unit.name, unit._pipeline))
         else:
             unit._pipeline = self
 
         unit.initialize(unit_name, *args, **kwargs)
-        self._workflow.add_nodes([unit._node])
+        self._units[unit_name] = unit
+        self._in_edges[unit_name] = {}
+        self._out_edges[unit_name] = {}
+        self._mark_dirty(unit_name)
 
     def remove_unit(self, unit_name):
+        self._check_not_in_batch('remove units')
         unit = self._units[unit_name]
         self._workflow.remove_nodes([unit._node])
 
         # remove all related edges
-        for ename, edge in self._edges.items():
-            if edge.src == unit_name or edge.dst == unit_name:
-                del self._edges[ename]
+        for edge in self.edges_of(unit_name):
+            if edge.src == unit_name:
+                self._mark_dirty(edge.dst)
+            self._remove_edge(edge)
         del self._units[unit_name]
+        del self._in_edges[unit_name]
+        del self._out_edges[unit_name]
+        self._dirty.discard(unit_name)
 
     def connect(self, src_name, src_port, dest_name, dest_port):
-        src = self._units[src_name]._node
-        dest = self._units[dest_name]._node
-
-        wf_src_port, wf_dest_port = self.handle_redirection(src_name, src_port, dest_name, dest_port)
-        self._workflow.connect(src, str(wf_src_port), dest, str(wf_dest_port))
+        # fail early on unknown units
+        self._units[src_name], self._units[dest_name]
 
         edge = base.Edge(src_name, src_port, dest_name, dest_port)
-        self._edges[edge.id] = edge
+
+        if self._batch is not None:
+            self._batch['edges'].append(edge)
+        else:
+            self._connect_edges([edge])
 
         return edge
 
@@ -307,6 +896,7 @@ class NipypeWrapperPipeline(base.GenericPipeline):
             raise Exception("Edge '%s' not found!" % edge.id)
 
     def disconnect(self, src_name, src_port, dest_name, dest_port):     
+        self._check_not_in_batch('remove edges')
         edge = self.find_edge(src_name, src_port, dest_name, dest_port)
 
         src = self._units[src_name]._node
@@ -314,7 +904,71 @@ class NipypeWrapperPipeline(base.GenericPipeline):
 
         wf_src_port, wf_dest_port = self.handle_redirection(src_name, src_port, dest_name, dest_port)
         self._workflow.disconnect(src, str(wf_src_port), dst, str(wf_dest_port))
+        self._remove_edge(edge)
+        self._mark_dirty(dest_name)
+
+    def _replace_node(self, unit, node):
+        """Swap the nipype node of the unit for another one (e.g. of a
+        different node type), keeping all its connections"""
+        edges = self.edges_of(unit.name)
+
+        # removing the node removes its connections as well
+        self._workflow.remove_nodes([unit._node])
+        unit._node = node
+        self._workflow.add_nodes([node])
+        self._connect_edges(edges)
+
+    def _add_edge(self, edge):
+        self._edges[edge.id] = edge
+        self._out_edges[edge.src][edge.id] = edge
+        self._in_edges[edge.dst][edge.id] = edge
+
+    def _remove_edge(self, edge):
         del self._edges[edge.id]
+        del self._out_edges[edge.src][edge.id]
+        del self._in_edges[edge.dst][edge.id]
+
+    def edges_of(self, unit_name):
+        """Returns a list of all edges going in or out of the unit"""
+        edges = dict(self._in_edges[unit_name])
+        edges.update(self._out_edges[unit_name])
+        return edges.values()
+
+    def upstream(self, unit_name):
+        """Returns a set of names of the units, connected to the inputs of
+        the given unit"""
+        return set(edge.src for edge in self._in_edges[unit_name].values())
+
+    def downstream(self, unit_name):
+        """Returns a set of names of the units, connected to the outputs of
+        the given unit"""
+        return set(edge.dst for edge in self._out_edges[unit_name].values())
+
+    def _closure(self, unit_names, neighbours):
+        """Returns a set of the given unit names and all units reachable
+        from them via 'neighbours' (i.e. self.upstream or self.downstream)"""
+        closure = set()
+        front = list(unit_names)
+        while front:
+            unit_name = front.pop()
+            if unit_name in closure:
+                continue
+            closure.add(unit_name)
+            front.extend(neighbours(unit_name))
+
+        return closure
+
+    def _mark_dirty(self, unit_name):
+        self._dirty.add(unit_name)
+
+    def dirty_units(self):
+        """Returns the set of names of the units, which will be re-executed
+        by the next run: the units changed since the last successful run and
+        everything downstream of them"""
+        if not self._has_run:
+            return set(self._units)
+
+        return self._closure(self._dirty, self.downstream)
 
     def handle_redirection(self, src_name, src_port, dest_name, dest_port):
         """Due to dynamical nature of nipype's connectivity, we allow for
@@ -330,95 +984,684 @@ class NipypeWrapperPipeline(base.GenericPipeline):
 
         if src_unit.redirect_out_ports and\
                 (src_port in src_unit.redirected_out_ports):
-            wf_src_port = src_unit.get_parameter(redir_parameter_template % (src_port, 'out'))
+            wf_src_port = src_unit.get_redirection('out', src_port)
         if dest_unit.redirect_in_ports and\
                 (dest_port in dest_unit.redirected_in_ports):
             # experimental: add it to hidden ports
-            wf_dest_port = dest_unit.get_parameter(redir_parameter_template % (dest_port, 'in'))
+            wf_dest_port = dest_unit.get_redirection('in', dest_port)
 
         return wf_src_port, wf_dest_port
 
-    def run(self):
-        def status_callback(node, nip_status):
-            unit = self.get_unit(node.name)
-            if nip_status == 'start':
-                status = base.tools.Status.RUNNING
-            elif nip_status == 'end':
-                status = base.tools.Status.FINISHED
+    def _rewire(self, unit_name, port_type, port_name, old_nipype_port, new_nipype_port):
+        """Move the nipype connections of a redirected port of the unit from
+        the old nipype port to the new one. The pipeline edges stay the
+        same. If the new connections can't be made, the old ones are
+        restored"""
+        if port_type == 'in':
+            edges = [edge for edge in self._in_edges[unit_name].values()
+                    if edge.dstPort == port_name]
+        else:
+            edges = [edge for edge in self._out_edges[unit_name].values()
+                    if edge.srcPort == port_name]
+        if not edges:
+            return
+
+        old_connections = []
+        new_connections = []
+        for edge in edges:
+            wf_src_port, wf_dest_port = self.handle_redirection(edge.src, edge.srcPort, edge.dst, edge.dstPort)
+            if port_type == 'in':
+                old_ports = (str(wf_src_port), str(old_nipype_port))
             else:
-                status = base.tools.Status.FAILED
+                old_ports = (str(old_nipype_port), str(wf_dest_port))
+            src = self._units[edge.src]._node
+            dst = self._units[edge.dst]._node
+            old_connections.append((src, dst, [old_ports]))
+            new_connections.append((src, dst, [(str(wf_src_port), str(wf_dest_port))]))
+
+        self._workflow.disconnect(old_connections)
+        try:
+            self._workflow.connect(new_connections)
+        except Exception:
+            # disconnecting is a no-op for the connections never made
+            self._workflow.disconnect(new_connections)
+            self._workflow.connect(old_connections)
+            raise
+
+        for edge in edges:
+            self._mark_dirty(edge.dst)
+
+    def set_scratch_dir(self, scratch_dir):
+        """Put the working directory of the pipeline, i.e. all the
+        intermediate outputs, on a fast scratch (or tmpfs) file system. The
+        results, which are not written out by a sink, stay there as well.
+        Since nipype's cache is left behind, all units are run again next
+        time"""
+        self._workflow.base_dir = os.path.join(os.path.abspath(scratch_dir), self._workdir_name)
+        self._has_run = False
+
+    def set_execution_mode(self, mode, **plugin_args):
+        """Choose how the workflow is executed by 'run'. 'mode' is one of
+        the keys of 'execution_modes', the keyword arguments are passed over
+        to the respective nipype plugin (e.g. n_procs=8, memory_gb=32)"""
+        if not execution_modes.has_key(mode):
+            raise Exception("Unknown execution mode '%s', expected one of: %s" % (mode, ', '.join(sorted(execution_modes))))
+
+        self.execution_mode = mode
+        self.plugin_args = plugin_args
+
+    def _status_callback(self, node, nip_status):
+        """Nipype's status callback, receiving the 'start', 'end' and
+        'exception' events of the nodes"""
+        # the statuses are propagated by the dispatcher thread, not to keep
+        # the scheduler waiting
+        self._dispatcher.push(node, nip_status)
+
+    def _cancel_requested(self):
+        return bool(self._run_handle and self._run_handle.cancelled)
+
+    def _set_status(self, unit_name, status):
+        self.get_unit(unit_name).status = status
+        for listener in self._status_listeners:
+            listener(unit_name, status)
 
-            unit.status = status
-            
-        #self._workflow.run()
-        self._workflow.run(plugin_args={'status_callback': status_callback})
-        #self._workflow.run(plugin='MultiProc', plugin_args={'status_callback': status_callback, 'n_procs':4})
-        #self._workflow.run(plugin='IPython', plugin_args={'status_callback': status_callback})
-
-
-    @classmethod
-    def save(cls, ppl, fname):
-        """get the state representation of the current pipeline, and write it
-        to a file. It is a hacky parody on a pickle protocol, should be
-        eliminated with fire ASAP"""
-
-        if not isinstance(ppl, cls):
-            raise Exception("Cannot save pipeline: the passed pipeline instance has wrong type")
-
-        # nodes list in the form [(name, class_creation_func, class_creation_func_args, parameters)]
+    @property
+    def progress(self):
+        """Node counts of the current (or last) run per unit, see
+        StatusDispatcher"""
+        if self._dispatcher:
+            return self._dispatcher.progress
+        else:
+            return {}
+
+    def iterable_sources(self):
+        """Returns {unit_name: set(source names)}, where the sources are the
+        units with iterables, which the unit's node is copied for: the unit
+        itself and its upstream units, except for those whose iterables
+        are collapsed again by a join node on the way"""
+        sources = dict((unit_name, set()) for unit_name in self._units)
+        for source_name, source in self._units.items():
+            if not source._node.iterables:
+                continue
+
+            # all units reached from the source, except via its join nodes
+            reached = set()
+            front = [source_name]
+            while front:
+                unit_name = front.pop()
+                if unit_name in reached:
+                    continue
+                if getattr(self._units[unit_name]._node, 'joinsource', None) == source_name:
+                    continue
+                reached.add(unit_name)
+                front.extend(self.downstream(unit_name))
+
+            for unit_name in reached:
+                sources[unit_name].add(source_name)
+
+        return sources
+
+    def node_counts(self):
+        """Returns {unit_name: n}, where n is the number of nipype nodes the
+        unit expands to, due to the iterables of the unit itself and all of
+        its upstream units. Join nodes collapse the iterables of their join
+        source again"""
+        lengths = dict((unit_name, _iterables_length(unit._node))
+                for unit_name, unit in self._units.items())
+        return dict((unit_name, reduce(lambda a, b: a * b,
+                        [lengths[source_name] for source_name in sources], 1))
+                for unit_name, sources in self.iterable_sources().items())
+
+    def plan(self, n_procs=None, history=None):
+        """Dry run: returns the execution plan of the next run, with the
+        iterables expanded, but without running anything:
+
+            units: {unit_name: {'nodes', 'level', 'cached', 'node_duration', 'work'}}
+            levels: unit names by dependency level
+            total_nodes, total_work: over all units
+            critical_path: {'units': [...], 'duration': float}
+            wall_time: estimated wall time with 'n_procs' workers
+            unknown: units without timings, counted as 0 seconds
+            warnings: e.g. units with a suspiciously large fan-out
+
+        The durations are estimated from the timings of previous runs (see
+        TimingHistory). 'n_procs' defaults to the setting of the execution
+        mode, or the number of CPUs"""
+        if n_procs is None:
+            if self.execution_mode == 'serial':
+                n_procs = 1
+            else:
+                n_procs = self.plugin_args.get('n_procs', multiprocessing.cpu_count())
+        return make_plan(self, n_procs, history)
+
+    def sweep(self, grid):
+        """Returns a ParameterSweep running this pipeline for all
+        combinations of the parameter values in 'grid', e.g.
+        {'bet.frac': [0.3, 0.5]}"""
+        return ParameterSweep(self, grid)
+
+    def add_status_listener(self, listener):
+        """Register a function f(unit_name, status), which is called
+        whenever a unit changes its status during a run"""
+        self._status_listeners.append(listener)
+
+    def remove_status_listener(self, listener):
+        self._status_listeners.remove(listener)
+
+    def _get_plugin(self):
+        """Returns the plugin (name or instance) and plugin arguments for
+        the current execution mode"""
+        plugin, plugin_args = execution_modes[self.execution_mode]
+        plugin_args = dict(plugin_args)
+        plugin_args.update(self.plugin_args)
+        plugin_args['status_callback'] = self._status_callback
+
+        # nipype expects an instance if the plugin is not given by name
+        if not isinstance(plugin, basestring):
+            plugin = plugin(plugin_args=plugin_args)
+            if isinstance(plugin, CancellableMixin):
+                plugin.cancelled = self._cancel_requested
+
+        return plugin, plugin_args
+
+    def run(self, until=None, start_from=None, select=None):
+        """Run the pipeline. By default, the whole workflow is run. The
+        optional arguments restrict the run to a part of the pipeline, each
+        being a unit name or a list of unit names:
+
+            until: only these units and their upstream units
+            start_from: only these units and their downstream units
+            select: only these units
+
+        If several are given, only the units satisfying all of them are run.
+        In any case, the upstream units the selected units need are run as
+        well, which costs nothing if nipype finds their results in its
+        cache"""
+        if not self._run_lock.acquire(False):
+            raise Exception("Pipeline '%s' is already running" % self.name)
+
+        try:
+            units = self._select_units(until, start_from, select)
+
+            self.run_id = uuid.uuid4().hex
+            for unit in self._units.values():
+                unit.prepare_run()
+                use_result_store(unit._node,
+                        self.result_store if unit.use_result_store else None,
+                        type(unit).__name__)
+
+            # units which are not going to change keep their previous
+            # results, nipype will find them in its cache
+            dirty = self.dirty_units()
+            for unit_name in units:
+                if not unit_name in dirty:
+                    self._set_status(unit_name, base.tools.Status.FINISHED)
+
+            # statuses the units get back if the run is cancelled
+            previous_statuses = dict((unit_name, self._units[unit_name].status)
+                    for unit_name in units)
+
+            # what is left to do after this run
+            remaining = dirty - units
+
+            if len(units) < len(self._units):
+                workflow = self._sub_workflow(units)
+            else:
+                workflow = self._workflow
+
+            self.profile = PipelineProfile(self)
+            self._dispatcher = StatusDispatcher(self, self.status_interval)
+            self._dispatcher.event_handlers.append(self.profile.record_events)
+            self.cleaner = None
+            if self.cleanup_intermediates:
+                self.cleaner = IntermediateCleaner(self, self._dispatcher.progress)
+                self._dispatcher.event_handlers.append(self.cleaner.record_events)
+            self._dispatcher.start()
+            try:
+                if self.profile_resources:
+                    with _resource_monitor():
+                        self._run_shards(workflow, units)
+                else:
+                    self._run_shards(workflow, units)
+            finally:
+                self._dispatcher.stop()
+
+            # units with nodes dropped by a cancellation are neither
+            # finished nor failed
+            cancelled = set()
+            if self._cancel_requested():
+                for unit_name in units:
+                    progress = self._dispatcher.progress[unit_name]
+                    if not progress['failed'] and progress['finished'] < progress['total']:
+                        cancelled.add(unit_name)
+                        self._set_status(unit_name, previous_statuses[unit_name])
+
+            self._dirty = remaining | cancelled
+            self._has_run = True
+
+            # the removed intermediates have to be computed again next time.
+            # Since everything downstream of a dirty unit is re-run as well,
+            # the next run after a cleaned-up one recomputes nearly the whole
+            # graph, i.e. the incremental re-runs don't work together with
+            # 'cleanup_intermediates'
+            if self.cleaner:
+                self._dirty.update(self.cleaner.removed)
+
+            if cancelled:
+                raise RunCancelled("Run of pipeline '%s' was cancelled" % self.name,
+                        sorted(cancelled))
+
+            # the timings only improve the estimates of 'plan', the run
+            # succeeded anyway
+            if self.record_timings:
+                try:
+                    history = TimingHistory()
+                    history.update(self, self.profile)
+                    history.save()
+                except (IOError, OSError) as e:
+                    logger.warning("Timings of pipeline '%s' not recorded: %s", self.name, e)
+        finally:
+            self._run_lock.release()
+
+    def _select_units(self, until, start_from, select):
+        """Returns the names of the units a run with the given restrictions
+        (see 'run') has to execute"""
+        selected = set(self._units)
+        for unit_names, neighbours in ((until, self.upstream),
+                                       (start_from, self.downstream),
+                                       (select, None)):
+            if unit_names is None:
+                continue
+            if isinstance(unit_names, basestring):
+                unit_names = [unit_names]
+            for unit_name in unit_names:
+                if not self._units.has_key(unit_name):
+                    raise Exception("Unit '%s' is not in pipeline '%s'" % (unit_name, self.name))
+            if neighbours:
+                selected &= self._closure(unit_names, neighbours)
+            else:
+                selected &= set(unit_names)
+
+        # the inputs of the selected units have to be computed (or taken from
+        # the cache) as well
+        return self._closure(selected, self.upstream)
+
+    def _sub_workflow(self, unit_names):
+        """A workflow with the nodes of the given units only. It has the same
+        name and working directory as the pipeline's workflow, so that the
+        nodes share their results with full runs"""
+        workflow = pe.Workflow(name=self._workflow.name, base_dir=self._workflow.base_dir)
+        workflow.config = self._workflow.config
+        nodes = [self._units[unit_name]._node for unit_name in unit_names]
+        workflow._graph = self._workflow._graph.subgraph(nodes).copy()
+        return workflow
+
+    def _run_shards(self, workflow, unit_names):
+        """Run the workflow. If a unit splits its iterables into shards
+        (see NipypeWrapperUnit.get_shards), the workflow is run once per
+        shard with the iterables of that unit replaced by the shard, so that
+        nipype never expands more than one shard of the graph at a time. The
+        node directories are named after the iterable values, so the results
+        of all shards end up in the same places as after a single run.
+
+        That doesn't hold for join nodes over the sharded unit (e.g. a
+        PyFunction2 in batch mode), which would only see the items of one
+        shard at a time, so sharding is refused for them"""
+        sharded = [(unit, unit.get_shards()) for unit in self._units.values()
+                if unit.name in unit_names]
+        sharded = [(unit, shards) for unit, shards in sharded if shards]
+
+        if not sharded:
+            plugin, plugin_args = self._get_plugin()
+            workflow.run(plugin=plugin, plugin_args=plugin_args)
+            return
+
+        if len(sharded) > 1:
+            raise Exception("Only one sharded unit per pipeline is supported, got: %s" % ', '.join(unit.name for unit, shards in sharded))
+
+        unit, shards = sharded[0]
+        joins = sorted(unit_name for unit_name in unit_names
+                if getattr(self._units[unit_name]._node, 'joinsource', None) == unit.name)
+        if joins:
+            raise Exception("Unit '%s' can't be run in shards, since %s join%s over its iterables. Set its shard size to 0" % (unit.name, ', '.join("'%s'" % unit_name for unit_name in joins), 's' if len(joins) == 1 else ''))
+
+        node = unit._node
+        iterables = node.iterables
+        field = iterables[0]
+        try:
+            for i, shard in enumerate(shards):
+                if self._cancel_requested():
+                    break
+                self.shard_progress = (i + 1, len(shards))
+                node.iterables = (field, shard)
+
+                plugin, plugin_args = self._get_plugin()
+                workflow.run(plugin=plugin, plugin_args=plugin_args)
+        finally:
+            node.iterables = iterables
+            self.shard_progress = None
+
+    def run_async(self, **kwargs):
+        """Start 'run' in a background thread and return a RunHandle for
+        it right away. The keyword arguments are passed over to 'run'.
+
+        Only possible in the execution modes, which run the nodes in other
+        processes: nipype changes the working directory of the whole process
+        while running a node, so a node running in the background would
+        change it under the feet of the caller (and of the other runs)"""
+        if self.execution_mode in in_process_modes:
+            raise Exception("Pipeline '%s' can't run in the background in the '%s' execution mode, choose one of: %s" % (self.name, self.execution_mode, ', '.join(sorted(set(execution_modes) - in_process_modes))))
+        if self._run_handle:
+            raise Exception("Pipeline '%s' is already running" % self.name)
+
+        self._run_handle = RunHandle(self, kwargs)
+        self._run_handle._start()
+        return self._run_handle
+
+
+    def get_state(self):
+        """Returns the state of the pipeline as a plain, JSON-serializable
+        dict. Units refer to their classes by name (see 'unit_registry')"""
         units = []
-        for uname, unit in ppl._units.items():
+        for uname, unit in self._units.items():
             parameters = {}
 
             # unit parameters (functional parameters)
             for pname, p in unit.parameters_info.items():
                 parameters[pname] = p['value']
 
-            # add other miscellaneous attributes
-            parameters.update({'top': unit.to_dict()['top'],
-                'left': unit.to_dict()['left']})
+            unit_dict = unit.to_dict()
+            units.append({'name': uname,
+                        'class': unit.__class__.__name__,
+                        'parameters': parameters,
+                        'position': {'top': unit_dict['top'],
+                                     'left': unit_dict['left']}})
 
-            #units.append((uname, unit.__class__.__name__, parameters))
-            unit_state = {'name':uname,
-                        'class': unit.__class__,
-                        'parameters': parameters}
+        # edges are stored as [src, srcPort, dst, dstPort]
+        edges = [[edge.src, edge.srcPort, edge.dst, edge.dstPort]
+                for edge in self._edges.values()]
 
-            units.append(unit_state)
-        
-        # edge list
-        edges = ppl._edges.values()
-
-        # the resulting state object
-        state = {'name': ppl.name,
+        return {'format': pipeline_format,
+                'version': pipeline_format_version,
+                'name': self.name,
                 'units': units,
                 'edges': edges}
 
-        with open(fname, 'w') as f:
-            pickle.dump(state, f)
-
-    @classmethod 
-    def load(cls, fname):
-        """read the state representation from file and build a pipeline based
-        on that information"""
+    @classmethod
+    def from_state(cls, state):
+        """Build a pipeline from the state dict returned by 'get_state'. All
+        nodes are added to the workflow at once and all connections are made
+        in a single call, instead of growing the workflow unit by unit"""
+        ppl = cls(state['name'])
+
+        with ppl.batch():
+            for unit_state in state['units']:
+                class_name = unit_state['class']
+                if not unit_registry.has_key(class_name):
+                    raise Exception("Cannot load pipeline: unknown unit type '%s'" % class_name)
+
+                # create empty instance
+                unit = unit_registry[class_name]()
+                ppl.add_unit(unit, str(unit_state['name']))
+
+                # load state (i.e. parameter values and other attributes)
+                unit.set_parameters(dict((str(pname), pvalue)
+                    for pname, pvalue in unit_state['parameters'].items()))
+                for attr, value in unit_state['position'].items():
+                    setattr(unit, attr, value)
+
+            # connect the units. JSON gives unicode strings, nipype expects
+            # plain ones
+            for edge in state['edges']:
+                ppl.connect(*map(str, edge))
 
-        with open(fname) as f:
-            state = pickle.load(f)
+        return ppl
 
-        ppl = NipypeWrapperPipeline(state['name'])
+    def _connect_edges(self, edges):
+        """Make the nipype connections for a list of edges with a single
+        workflow.connect call and add the edges to the pipeline"""
+        # nipype expects [(src_node, dst_node, [(src_port, dst_port), ...])]
+        connections = {}
+        for edge in edges:
+            wf_src_port, wf_dest_port = self.handle_redirection(edge.src, edge.srcPort, edge.dst, edge.dstPort)
+            connections.setdefault((edge.src, edge.dst), []).append(
+                    (str(wf_src_port), str(wf_dest_port)))
+
+        if connections:
+            self._workflow.connect([(self._units[src_name]._node,
+                                     self._units[dest_name]._node,
+                                     ports)
+                                    for (src_name, dest_name), ports in connections.items()])
+
+        for edge in edges:
+            self._add_edge(edge)
+            self._mark_dirty(edge.dst)
 
-        for unit_state in state['units']:
-            # create empty instance
-            unit = unit_state['class']()
+    @classmethod
+    def save(cls, ppl, fname):
+        """Write the state of the pipeline (see 'get_state') to a JSON
+        file"""
 
-            # add to pipeline
-            ppl.add_unit(unit, unit_state['name'])
+        if not isinstance(ppl, cls):
+            raise Exception("Cannot save pipeline: the passed pipeline instance has wrong type")
 
-            # load state (i.e. parameter values and other attributes)
-            for pname, pvalue in unit_state['parameters'].items():
-                setattr(unit, pname, pvalue)
+        with open(fname, 'w') as f:
+            json.dump(ppl.get_state(), f, separators=(',', ':'))
 
-        # connect the units
-        for edge in state['edges']:
-            ppl.connect(edge.src, edge.srcPort, edge.dst, edge.dstPort)
+    @classmethod 
+    def load(cls, fname):
+        """read the state representation from file and build a pipeline based
+        on that information. Files written in older versions of the format,
+        including the old pickle-based files, are migrated on the fly"""
+
+        with open(fname, 'rb') as f:
+            data = f.read()
+
+        try:
+            state = json.loads(data)
+        except ValueError:
+            state = migrate_pickle_state(data)
+
+        if state.get('format') != pipeline_format:
+            raise Exception("Cannot load pipeline: %s is not a pipeline file" % fname)
+
+        while state['version'] < pipeline_format_version:
+            state = pipeline_migrations[state['version']](state)
+
+        if state['version'] > pipeline_format_version:
+            raise Exception("Cannot load pipeline: %s was saved with a newer format version %s" % (fname, state['version']))
+
+        return cls.from_state(state)
+
+
+# number of runs with 'profile_resources' in progress, and the setting of
+# nipype's (process-wide) resource monitor before the first of them
+_profiled_runs = 0
+_resource_monitor_setting = None
+_resource_monitor_lock = threading.Lock()
+
+@contextmanager
+def _resource_monitor():
+    """Enable nipype's resource monitor, until the last of the concurrent
+    profiled runs is over. Then the previous setting is restored"""
+    global _profiled_runs, _resource_monitor_setting
+    with _resource_monitor_lock:
+        if not _profiled_runs:
+            _resource_monitor_setting = nipype_config.resource_monitor
+            nipype_config.enable_resource_monitor()
+        _profiled_runs += 1
+    try:
+        yield
+    finally:
+        with _resource_monitor_lock:
+            _profiled_runs -= 1
+            if not _profiled_runs:
+                nipype_config.resource_monitor = _resource_monitor_setting
+
+
+def _iterables_length(node):
+    """Number of copies of the node nipype creates for its own iterables"""
+    iterables = node.iterables
+    if not iterables:
+        return 1
+    if isinstance(iterables, tuple):
+        iterables = [iterables]
+
+    lengths = [len(values) for field, values in iterables]
+    if getattr(node, 'synchronize', False):
+        return max(lengths)
+    else:
+        return reduce(lambda a, b: a * b, lengths, 1)
+
+
+class RunCancelled(Exception):
+    """Raised by a run, which was cancelled via RunHandle.cancel. 'units'
+    are the names of the units, which didn't get to run all their nodes"""
+
+    def __init__(self, message, units=()):
+        super(RunCancelled, self).__init__(message)
+        self.units = list(units)
+
+
+class RunHandle(object):
+    """Handle of a pipeline run, executing in a background thread (see
+    NipypeWrapperPipeline.run_async).
+
+    The run is in one of the states 'running', 'finished', 'failed' or
+    'cancelled'. Unit status changes are recorded as (unit_name, status)
+    events, which can be consumed via 'events'. Cancellation is cooperative:
+    the nodes, which are already running, are finished, but no new nodes are
+    started. The units left unfinished keep their status from before the
+    run, are listed in 'cancelled_units' and get a (unit_name, 'cancelled')
+    event"""
+
+    def __init__(self, pipeline, run_kwargs):
+        self.pipeline = pipeline
+        self.cancelled = False
+        self.cancelled_units = []
+
+        # the exception and its formatted traceback, if the run has failed
+        self.error = None
+        self.traceback = None
+
+        self._run_kwargs = run_kwargs
+        self._events = Queue.Queue()
+        self._finished = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                name='run-%s' % pipeline.name)
+        self._thread.daemon = True
+
+    def _start(self):
+        self.pipeline.add_status_listener(self._on_status)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self.pipeline.run(**self._run_kwargs)
+        except RunCancelled as e:
+            self.error = e
+            self.cancelled_units = e.units
+            for unit_name in e.units:
+                self._events.put((unit_name, 'cancelled'))
+        except Exception as e:
+            self.error = e
+            self.traceback = traceback.format_exc()
+        finally:
+            self.pipeline.remove_status_listener(self._on_status)
+            if self.pipeline._run_handle is self:
+                self.pipeline._run_handle = None
+            self._finished.set()
+
+            # wake up the consumers of 'events'
+            self._events.put(None)
+
+    def _on_status(self, unit_name, status):
+        self._events.put((unit_name, status))
 
-        return ppl
+    @property
+    def state(self):
+        if not self._finished.is_set():
+            return 'running'
+        elif self.error is None:
+            return 'finished'
+        elif self.cancelled:
+            return 'cancelled'
+        else:
+            return 'failed'
+
+    def done(self):
+        """Non-blocking check, whether the run is over"""
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the run is over or the timeout (in seconds) expires.
+        Returns the state of the run"""
+        self._finished.wait(timeout)
+        return self.state
+
+    def result(self, timeout=None):
+        """Like 'wait', but re-raises the exception of a failed run"""
+        state = self.wait(timeout)
+        if state == 'failed':
+            raise self.error
+        return state
+
+    def cancel(self):
+        """Request the run to stop"""
+        self.cancelled = True
+
+    def events(self, timeout=None):
+        """Generator of (unit_name, status) events, ending together with
+        the run. If no event arrives within 'timeout' seconds, None is
+        yielded, so that the consumer can do something else in between"""
+        while True:
+            try:
+                event = self._events.get(timeout=timeout)
+            except Queue.Empty:
+                yield None
+                continue
+
+            if event is None:
+                # leave the end marker for other consumers
+                self._events.put(None)
+                return
+            yield event
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """Unpickler for the old pipeline files, which resolves unit classes,
+    which are not importable anymore (e.g. moved to another module), via the
+    'unit_registry'"""
+    def find_class(self, module, name):
+        try:
+            return pickle.Unpickler.find_class(self, module, name)
+        except (ImportError, AttributeError):
+            if unit_registry.has_key(name):
+                return unit_registry[name]
+            raise
+
+
+def migrate_pickle_state(data):
+    """Convert the contents of a pickle-based pipeline file (the format used
+    before the versioned one) into a state dict of version 1"""
+    from StringIO import StringIO
+    old_state = _LegacyUnpickler(StringIO(data)).load()
+
+    units = []
+    for unit_state in old_state['units']:
+        parameters = dict(unit_state['parameters'])
+        position = {'top': parameters.pop('top'),
+                    'left': parameters.pop('left')}
+        units.append({'name': unit_state['name'],
+                    'class': unit_state['class'].__name__,
+                    'parameters': parameters,
+                    'position': position})
+
+    edges = [[edge.src, edge.srcPort, edge.dst, edge.dstPort]
+            for edge in old_state['edges']]
+
+    return {'format': pipeline_format,
+            'version': 1,
+            'name': old_state['name'],
+            'units': units,
+            'edges': edges}
@@ -0,0 +1,460 @@
+"""Custom nipype interfaces used by the units of the nipype backend"""
+
+import os
+import glob
+import json
+import time
+import shutil
+import fnmatch
+import hashlib
+import threading
+import subprocess
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+import nipype.interfaces.io as nio
+import nipype.interfaces.utility as util
+from nipype.interfaces.base import traits, isdefined
+from nipype.utils.filemanip import split_filename, get_related_files
+
+from nipype_wrapper_paths import user_temp_dir
+
+try:
+    from nipype.utils.functions import create_function_from_source
+except ImportError:
+    # older nipype versions
+    from nipype.utils.misc import create_function_from_source
+
+
+##############################################################################
+# Python function with compiled code cache
+##############################################################################
+
+# compiled functions by the hash of their source code and imports. Lives as
+# long as the process, i.e. it is shared by all nodes, iterations and runs
+# executed in the server process or in the same worker process
+_function_cache = {}
+
+def get_function(function_str, imports=None):
+    """Returns the function defined by the source code 'function_str',
+    compiling it only once per process"""
+    key = hashlib.sha1(repr((function_str, imports))).hexdigest()
+    if not _function_cache.has_key(key):
+        _function_cache[key] = create_function_from_source(function_str, imports)
+    return _function_cache[key]
+
+
+class ArrayRef(str):
+    """Path of a .npy file, passed between function nodes instead of the
+    array itself (see CachedFunction). Being a string, it is pickled into the
+    node results and hashed by nipype at no cost"""
+
+    def load(self):
+        """Returns a read-only memory-mapped view of the array"""
+        return np.load(self, mmap_mode='r')
+
+
+def store_array(array, dirname):
+    """Write the array to a .npy file in 'dirname', named by the digest
+    of its contents, and return its ArrayRef. Equal arrays end up in the
+    same file, so nipype's input hashes stay stable between runs"""
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(str(array.dtype) + str(array.shape))
+    digest.update(array.data if array.size else '')
+    fname = os.path.join(os.path.abspath(dirname), 'array_%s.npy' % digest.hexdigest())
+    if not os.path.exists(fname):
+        tmp_fname = '%s.%d.tmp.npy' % (fname[:-4], os.getpid())
+        np.save(tmp_fname, array)
+        os.rename(tmp_fname, fname)
+    return ArrayRef(fname)
+
+
+class CachedFunctionInputSpec(util.FunctionInputSpec):
+    # not arguments of the function: handled by the PyFunction2 unit
+    batch_mode = traits.Bool(False, usedefault=True,
+            desc='call the function once with the lists of all iterable values')
+    array_threshold = traits.Int(1 << 20, usedefault=True,
+            desc='numpy arrays of at least that many bytes are passed to the downstream nodes as .npy files. Negative: never')
+
+
+class CachedFunction(util.Function):
+    """nipype's Function interface, which doesn't compile the function source
+    for every execution (see 'get_function').
+
+    Large numpy arrays returned by the function are written once as .npy files
+    into the node directory and passed on as ArrayRef paths, instead of being
+    pickled into the results. ArrayRef inputs are handed to the function as
+    read-only memory-mapped arrays"""
+
+    input_spec = CachedFunctionInputSpec
+
+    def _run_interface(self, runtime):
+        function_handle = get_function(self.inputs.function_str,
+                getattr(self, 'imports', None))
+
+        # loaded arrays by id, so that an input returned unchanged keeps its
+        # file instead of being written again
+        loaded = {}
+
+        args = {}
+        for name in self._input_names:
+            value = getattr(self.inputs, name)
+            if isdefined(value):
+                args[name] = self._load_arrays(value, loaded)
+
+        out = function_handle(**args)
+
+        if len(self._output_names) == 1:
+            out = [out]
+        elif isinstance(out, tuple) and (len(out) != len(self._output_names)):
+            raise RuntimeError('Mismatch in number of expected outputs')
+
+        for idx, name in enumerate(self._output_names):
+            self._out[name] = self._store_arrays(out[idx], runtime.cwd, loaded)
+
+        return runtime
+
+    def _load_arrays(self, value, loaded):
+        if isinstance(value, ArrayRef):
+            array = value.load()
+            loaded[id(array)] = (array, value)
+            return array
+        if isinstance(value, (list, tuple)):
+            # e.g. the joined values in batch mode
+            return type(value)(self._load_arrays(item, loaded) for item in value)
+        return value
+
+    def _store_arrays(self, value, dirname, loaded):
+        threshold = self.inputs.array_threshold
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject \
+                and threshold >= 0 and value.nbytes >= threshold:
+            if id(value) in loaded and loaded[id(value)][0] is value:
+                return loaded[id(value)][1]
+            return store_array(value, dirname)
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._store_arrays(item, dirname, loaded) for item in value)
+        return value
+
+
+##############################################################################
+# Data sink with links and parallel copying
+##############################################################################
+
+def file_md5(fname, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def same_content(src, dst):
+    """Check whether dst already has the contents of src. The files are only
+    hashed if their sizes match"""
+    if not os.path.exists(dst):
+        return False
+    if os.path.samefile(src, dst):
+        return True
+    if os.path.getsize(src) != os.path.getsize(dst):
+        return False
+    return file_md5(src) == file_md5(dst)
+
+
+def _link(src, dst, link_mode):
+    """Try to create dst as a link to src. Returns False, if it wasn't
+    possible (e.g. a hardlink across file systems)"""
+    try:
+        if link_mode == 'hardlink':
+            os.link(src, dst)
+        elif link_mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+        elif link_mode == 'reflink':
+            with open(os.devnull, 'w') as devnull:
+                if subprocess.call(['cp', '--reflink=always', src, dst],
+                        stderr=devnull) != 0:
+                    return False
+        else:
+            return False
+    except OSError:
+        return False
+
+    return True
+
+
+def transfer_file(src, dst, link_mode='copy'):
+    """Make dst have the contents of src, along with the related files (e.g.
+    .hdr of an .img), using the given link mode: 'copy', 'hardlink',
+    'reflink' or 'symlink'. If linking fails, the file is copied. Returns
+    False, if dst already had the same contents and nothing was done"""
+    if same_content(src, dst):
+        return False
+
+    dst_path, dst_base, _ = split_filename(dst)
+    pairs = [(src, dst)]
+    for related in get_related_files(src, include_this_file=False):
+        _, _, ext = split_filename(related)
+        pairs.append((related, os.path.join(dst_path, dst_base + ext)))
+
+    for src_file, dst_file in pairs:
+        if os.path.lexists(dst_file):
+            os.remove(dst_file)
+        if not _link(src_file, dst_file, link_mode):
+            shutil.copy2(src_file, dst_file)
+
+    return True
+
+
+class LinkingDataSinkInputSpec(nio.DataSinkInputSpec):
+    link_mode = traits.Enum('copy', 'hardlink', 'reflink', 'symlink',
+            usedefault=True,
+            desc='how the files are put into base_directory. If linking is not possible, files are copied')
+    copy_threads = traits.Int(4, usedefault=True,
+            desc='number of files transferred in parallel')
+
+
+# serializes the collection phase of LinkingDataSink._list_outputs, which
+# temporarily replaces nipype.interfaces.io.copyfile
+_copyfile_lock = threading.Lock()
+
+class LinkingDataSink(nio.DataSink):
+    """nipype's DataSink, which can link the files instead of copying them,
+    transfers the files in parallel and skips the files, which are already
+    present at the destination with the same contents"""
+
+    input_spec = LinkingDataSinkInputSpec
+
+    def _list_outputs(self):
+        # let DataSink do all the path handling, but only collect the files
+        # it would copy
+        transfers = []
+        def collect(src, dst, *args, **kwargs):
+            transfers.append((src, dst))
+
+        with _copyfile_lock:
+            copyfile = nio.copyfile
+            nio.copyfile = collect
+            try:
+                outputs = super(LinkingDataSink, self)._list_outputs()
+            finally:
+                nio.copyfile = copyfile
+
+        link_mode = self.inputs.link_mode
+        pool = ThreadPool(max(1, self.inputs.copy_threads))
+        try:
+            pool.map(lambda transfer: transfer_file(transfer[0], transfer[1], link_mode),
+                    transfers)
+        finally:
+            pool.close()
+
+        return outputs
+
+
+##############################################################################
+# Data grabber with a directory index
+##############################################################################
+
+# where the directory indexes are persisted, to be shared between processes
+index_cache_dir = user_temp_dir('indexes')
+
+class DirectoryIndex(object):
+    """In-memory listing of a directory tree: {relative dir: (mtime,
+    names)}. Answers glob patterns without touching the file system"""
+
+    def __init__(self, root, dirs=None, generation=None):
+        self.root = os.path.abspath(root)
+        self.dirs = dirs or {}
+        self._names = dict((d, set(names)) for d, (mtime, names) in self.dirs.items())
+
+        # time of the last validation, and the run it was validated for,
+        # see 'get_directory_index'
+        self.checked = 0
+        self.generation = generation
+
+    def scan(self):
+        """List the whole tree in a single walk. Symlinked directories are
+        followed like glob does, except for links back to a directory
+        above them"""
+        self.dirs = {}
+
+        # (device, inode) of the directories on the way down to a directory
+        parents = {'': frozenset()}
+        for dirpath, dirnames, filenames in os.walk(self.root, followlinks=True):
+            rel = os.path.relpath(dirpath, self.root)
+            if rel == os.curdir:
+                rel = ''
+            st = os.stat(dirpath)
+            self.dirs[rel] = (st.st_mtime, sorted(dirnames + filenames))
+
+            chain = parents.pop(rel) | set([(st.st_dev, st.st_ino)])
+            for dirname in list(dirnames):
+                try:
+                    sub = os.stat(os.path.join(dirpath, dirname))
+                except OSError:
+                    dirnames.remove(dirname)
+                    continue
+                if (sub.st_dev, sub.st_ino) in chain:
+                    # a loop
+                    dirnames.remove(dirname)
+                else:
+                    parents[os.path.join(rel, dirname)] = chain
+        self._names = dict((d, set(names)) for d, (mtime, names) in self.dirs.items())
+
+    def is_valid(self):
+        """The index is valid as long as none of the directories has been
+        modified"""
+        if not self.dirs:
+            return False
+        try:
+            for rel, (mtime, names) in self.dirs.items():
+                if os.stat(os.path.join(self.root, rel)).st_mtime != mtime:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def glob(self, pattern):
+        """Same as glob.glob, for patterns inside the root directory"""
+        rel = os.path.relpath(os.path.abspath(pattern), self.root)
+        if rel.startswith(os.pardir):
+            return glob.glob(pattern)
+
+        matches = ['']
+        for component in rel.split(os.sep):
+            next_matches = []
+            for match in matches:
+                names = self._names.get(match)
+                if names is None:
+                    # not a directory
+                    continue
+                if glob.has_magic(component):
+                    found = fnmatch.filter(self.dirs[match][1], component)
+                    if not component.startswith('.'):
+                        found = [name for name in found if not name.startswith('.')]
+                elif component in names:
+                    found = [component]
+                else:
+                    found = []
+                next_matches += [os.path.join(match, name) for name in found]
+            matches = next_matches
+
+        return [os.path.join(self.root, match) for match in matches]
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname) as f:
+            data = json.load(f)
+        dirs = dict((d, tuple(entry)) for d, entry in data['dirs'].items())
+        return cls(data['root'], dirs, data.get('generation'))
+
+    def save(self, fname):
+        # write to a temporary file first, since other processes might read
+        # the index concurrently
+        tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+        with open(tmp_fname, 'w') as f:
+            json.dump({'root': self.root, 'dirs': self.dirs,
+                       'generation': self.generation}, f)
+        os.rename(tmp_fname, fname)
+
+
+_directory_indexes = {}
+_directory_indexes_lock = threading.Lock()
+
+def get_directory_index(root, max_age=0., generation=None):
+    """Returns the DirectoryIndex of 'root'. Validating the index against
+    the directory mtimes takes a stat per directory, so it is done once per
+    'generation' (the pipeline passes the id of its run): the first node of
+    a run validates the index, the later ones, in this or another process,
+    reuse it. This way the files created right before a run are found, but
+    the tree is expected not to change during the run. Without a
+    generation, the index is validated on every call, unless 'max_age'
+    skips the validation for that many seconds within the process.
+
+    Between processes, the index is shared via 'index_cache_dir'. Keeping it
+    there is best effort, an index which can't be stored is just rebuilt by
+    the next process"""
+    root = os.path.abspath(root)
+    fname = os.path.join(index_cache_dir,
+            hashlib.sha1(root).hexdigest() + '.json')
+
+    with _directory_indexes_lock:
+        index = _directory_indexes.get(root)
+        now = time.time()
+        if index and generation and index.generation == generation:
+            return index
+        if index and max_age and now - index.checked < max_age:
+            return index
+
+        if index is None or (generation and index.generation != generation):
+            try:
+                stored = DirectoryIndex.load(fname)
+            except (IOError, OSError, ValueError, KeyError):
+                stored = None
+            if stored is not None and stored.root == root:
+                index = stored
+        if index is None:
+            index = DirectoryIndex(root)
+
+        if not (generation and index.generation == generation):
+            if not index.is_valid():
+                index.scan()
+            index.generation = generation
+            try:
+                if not os.path.isdir(index_cache_dir):
+                    os.makedirs(index_cache_dir)
+                index.save(fname)
+            except (IOError, OSError):
+                pass
+
+        index.checked = now
+        _directory_indexes[root] = index
+        return index
+
+
+class _IndexedGlobModule(object):
+    """Stands in for the glob module inside nipype.interfaces.io"""
+    def __init__(self, index):
+        self._index = index
+
+    def glob(self, pattern):
+        return self._index.glob(pattern)
+
+    def __getattr__(self, name):
+        return getattr(glob, name)
+
+
+class IndexedDataGrabberInputSpec(nio.DataGrabberInputSpec):
+    use_index = traits.Bool(True, usedefault=True,
+            desc='resolve the templates from an index of base_directory')
+    index_max_age = traits.Float(0., usedefault=True,
+            desc='seconds, for which the index is used without checking it for changes')
+    index_generation = traits.Str(nohash=True,
+            desc='the index is only checked for changes once per generation (e.g. run)')
+
+
+# serializes IndexedDataGrabber._list_outputs, which temporarily replaces
+# nipype.interfaces.io.glob
+_glob_lock = threading.Lock()
+
+class IndexedDataGrabber(nio.DataGrabber):
+    """nipype's DataGrabber, which resolves the templates from an index of
+    base_directory (see DirectoryIndex) instead of globbing the file system
+    for every subject and every output field"""
+
+    input_spec = IndexedDataGrabberInputSpec
+
+    def _list_outputs(self):
+        if not self.inputs.use_index or not isdefined(self.inputs.base_directory):
+            return super(IndexedDataGrabber, self)._list_outputs()
+
+        generation = None
+        if isdefined(self.inputs.index_generation):
+            generation = self.inputs.index_generation
+        index = get_directory_index(self.inputs.base_directory,
+                self.inputs.index_max_age, generation)
+        with _glob_lock:
+            glob_module = nio.glob
+            nio.glob = _IndexedGlobModule(index)
+            try:
+                return super(IndexedDataGrabber, self)._list_outputs()
+            finally:
+                nio.glob = glob_module
@@ -3,19 +3,19 @@
 # Nipype wrapper base classes
 from nipype_wrapper_base import NipypeWrapperUnit as Unit
 from nipype_wrapper_base import NipypeWrapperPipeline as Pipeline
+from nipype_wrapper_base import LazyInterface
 
 # Parameter descriptor
 from earlpipeline.backends.base import Parameter
 
-# Nipype API
-import nipype.interfaces.io as nio
-import nipype.interfaces.fsl as fsl
-import nipype.interfaces.utility as util
+# Nipype API. The interface modules (nipype.interfaces.fsl etc.) are only
+# imported by the interface factories below (see LazyInterface), so that the
+# server starts quickly
+import nipype.pipeline.engine as pe
 import os
+import re
 import inspect
-from nipype.workflows.dmri.fsl.dti import create_eddy_correct_pipeline, create_bedpostx_pipeline
-
-import __builtin__
+import numpy as np
 
 # parameter shortcuts
 def text_parameter(name, default):
@@ -34,12 +34,15 @@ def boolean_parameter(name, default):
 # PrimitiveSource
 ##############################################################################
 
-I = util.IdentityInterface(fields=['str_par', 'float_par', 'int_par', 'bool_par'])
+def primitive_source_iface():
+    import nipype.interfaces.utility as util
+    return util.IdentityInterface(fields=['str_par', 'float_par', 'int_par', 'bool_par'])
 
 class PrimitiveSource(Unit):
-    interface = I
+    interface = LazyInterface(primitive_source_iface)
     tag = "Sources"
     instance_name_template = "primsrc"
+    use_result_store = False
 
     # hide the in port. Use it as a parameter
     hidden_in_ports = ['str_par',
@@ -56,34 +59,174 @@ class PrimitiveSource(Unit):
 # IterableSource
 ##############################################################################
 
-I = util.IdentityInterface(fields=['output_val'])
+class IterableItems(object):
+    """Read-only sequence of iterable values, backed by a numpy array. The
+    values are only converted to python objects (which nipype needs to hash
+    the inputs) on access, so that long lists are stored compactly"""
+
+    # number of values converted at once while iterating
+    chunk_size = 4096
+
+    def __init__(self, array):
+        self.array = array
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        for start in xrange(0, len(self.array), self.chunk_size):
+            for value in self.array[start:start + self.chunk_size].tolist():
+                yield value
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return IterableItems(self.array[index])
+        return self.array[index].item()
+
+    def __repr__(self):
+        return '%s(%d items)' % (type(self).__name__, len(self))
+
+
+class StringItems(IterableItems):
+    """IterableItems of strings, stored as the text they were read from and
+    the offsets of the lines. Unlike a numpy string array, which pads every
+    value to the longest one, this takes about the size of the file"""
+
+    def __init__(self, text, starts, ends):
+        self.text = text
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        text = self.text
+        for start in xrange(0, len(self.starts), self.chunk_size):
+            for begin, end in zip(self.starts[start:start + self.chunk_size].tolist(),
+                                  self.ends[start:start + self.chunk_size].tolist()):
+                yield text[begin:end]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return StringItems(self.text, self.starts[index], self.ends[index])
+        return self.text[int(self.starts[index]):int(self.ends[index])]
+
+
+# numpy types for the numerical iterable types
+iterable_dtypes = {'int': np.int64, 'float': np.float64}
+
+# a line, which is neither blank nor a single value of the type. numpy
+# parses the numbers up to the first character it can't use (e.g. '1.5' as
+# an int gives 1), so the lines are checked first
+_invalid_line = {
+    'int': re.compile(r'^(?![ \t\r\f\v]*(?:[+-]?\d+)?[ \t\r\f\v]*$).', re.M),
+    'float': re.compile(r'^(?![ \t\r\f\v]*(?:[+-]?(?:(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?'
+                        r'|inf|infinity|nan))?[ \t\r\f\v]*$).', re.M | re.I)}
+
+def _line_offsets(text):
+    """Returns the start and end offsets of the lines of the text as
+    arrays. A newline at the end doesn't start another line"""
+    ends = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == ord('\n'))
+    if text and not text.endswith('\n'):
+        ends = np.append(ends, len(text))
+    starts = np.concatenate(([0], ends[:-1] + 1))[:len(ends)].astype(ends.dtype)
+    return starts, ends
+
+
+# already loaded iterable files: (path, iterable_type) -> (stat, IterableItems)
+_iterable_cache = {}
+
+def load_iterable(path, iterable_type):
+    """Read the values from a file with one value per line and convert
+    them to the given type ('str', 'int' or 'float'). Numbers are checked
+    by a regular expression and parsed by numpy in one pass each, the lines
+    of strings are located by numpy as well.
+    The result is cached until the file is modified"""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stat = (st.st_mtime, st.st_size)
+
+    key = (path, iterable_type)
+    if _iterable_cache.has_key(key) and _iterable_cache[key][0] == stat:
+        return _iterable_cache[key][1]
+
+    if not iterable_dtypes.has_key(iterable_type) and iterable_type != 'str':
+        raise Exception("Unknown iterable type '%s'" % iterable_type)
+
+    with open(path) as f:
+        text = f.read()
+
+    starts, ends = _line_offsets(text)
+    if iterable_type == 'str':
+        items = StringItems(text, starts, ends)
+    else:
+        invalid = _invalid_line[iterable_type].search(text)
+        if invalid:
+            line = text[invalid.start():].split('\n', 1)[0]
+            raise Exception("Could not read %s: line %d is not a %s value: %r" % (path, text.count('\n', 0, invalid.start()) + 1, iterable_type, line))
+
+        # numpy stops at the first value it can't parse, without an error,
+        # so the values are counted against the non-blank lines
+        array = np.fromstring(text, dtype=iterable_dtypes[iterable_type], sep=' ')
+        printable = np.concatenate(([0], np.cumsum(np.frombuffer(text, dtype=np.uint8) > ord(' '))))
+        n_lines = np.count_nonzero(printable[ends] > printable[starts])
+        if len(array) != n_lines:
+            raise Exception("Could not read %s: expected one %s value per line, got %d values from %d lines" % (path, iterable_type, len(array), n_lines))
+        items = IterableItems(array)
+
+    _iterable_cache[key] = (stat, items)
+    return items
+
+
+def iterable_source_iface():
+    import nipype.interfaces.utility as util
+    return util.IdentityInterface(fields=['output_val'])
 
 class IterableSource(Unit):
-    interface = I
+    interface = LazyInterface(iterable_source_iface)
     tag = "Sources"
     instance_name_template = "itsrc"
     check_in_ports = False
+    use_result_store = False
 
     # obviously
     hidden_in_ports = ['output_val',
             'iterable_file',
-            'iterable_type']
+            'iterable_type',
+            'shard_size']
 
     iterable_file = path_parameter('iterable_file', 'iterable.txt')
     iterable_type = Parameter('iterable_type', 'dropdown', str, 'str',
             items = ['str', 'int', 'float'])
 
-    # augment the 'set_parameter' method to set the iterable
-    def set_parameter(self, name, value):
-        # run the original method first
-        super(IterableSource, self).set_parameter(name, value)
+    # if > 0, the pipeline is run in shards of that many items, to bound the
+    # size of the expanded graph
+    shard_size = int_parameter('shard_size', 0)
+
+    def _after_set_parameters(self, values):
+        super(IterableSource, self)._after_set_parameters(values)
+
+        # if the file or the type has changed, set the iterables. Unchanged
+        # files are not read again (see 'load_iterable')
+        if 'iterable_file' in values or 'iterable_type' in values:
+            iterable_file = getattr(self._node.inputs, 'iterable_file', None)
+            iterable_type = getattr(self._node.inputs, 'iterable_type', 'str')
+            if iterable_file:
+                items = load_iterable(iterable_file, iterable_type)
+                self._node.iterables = ("output_val", items)
+
+    def get_shards(self):
+        shard_size = getattr(self._node.inputs, 'shard_size', 0)
+        if not shard_size or not self._node.iterables:
+            return None
 
-        # if it is iterable_file parameter, set the iterables
-        if name == 'iterable_file':
-            item_type = getattr(__builtin__, self.iterable_type)
-            with open(value) as f:
-                items = [item_type(line.rstrip('\n')) for line in f.readlines()]
-                self._node.iterables = ("output_val", items) 
+        items = self._node.iterables[1]
+        if len(items) <= shard_size:
+            return None
+
+        return [items[start:start + shard_size]
+                for start in xrange(0, len(items), shard_size)]
 
 
 ##############################################################################
@@ -112,17 +255,21 @@ def func(in_val1=None, in_val2=None):
 def after_read(val):
     return pickle.loads(val)
 
-func_iface = util.Function(input_names=['in_val1', 'in_val2'],
-        output_names=['out_val1', 'out_val2'])
+def func_iface():
+    from nipype_wrapper_custom_interfaces import CachedFunction
+    return CachedFunction(input_names=['in_val1', 'in_val2'],
+            output_names=['out_val1', 'out_val2'])
 
 class PyFunction2(Unit):
-    interface = func_iface
+    interface = LazyInterface(func_iface)
     tag = "Utility"
     instance_name_template = "func"
 
     hidden_in_ports = [
             'ignore_exception',
-            'function_str']
+            'function_str',
+            'batch_mode',
+            'array_threshold']
 
     ignore_exception = boolean_parameter('ignore_exception', False)
     function_str = Parameter('function_str', 'code', str,
@@ -130,6 +277,50 @@ class PyFunction2(Unit):
             after_read=after_read,
             lang='python')
 
+    # in batch mode, the function is called only once, with the lists of
+    # values of all iterations of the upstream iterable unit as arguments
+    batch_mode = boolean_parameter('batch_mode', False)
+
+    # numpy arrays of at least that many bytes are handed to the downstream
+    # units as memory-mapped .npy files instead of being pickled. The
+    # function receives such arrays read-only, np.array(x) makes a writable
+    # copy. Negative: never
+    array_threshold = int_parameter('array_threshold', 1 << 20)
+
+    # the function may return the paths (or arrays) it got
+    passes_through_files = True
+
+    def prepare_run(self):
+        # batch mode is implemented by turning the node into a nipype
+        # JoinNode, joining over the upstream unit with iterables
+        join_source = None
+        if self._node.inputs.batch_mode:
+            upstream = self.pipeline._closure([self.name], self.pipeline.upstream)
+            sources = [unit_name for unit_name in upstream
+                    if self.pipeline.get_unit(unit_name)._node.iterables]
+            if len(sources) > 1:
+                raise Exception("Batch mode of %s needs a single upstream unit with iterables, got: %s" % (self.name, ', '.join(sources)))
+            if sources:
+                join_source = sources[0]
+
+        if getattr(self._node, 'joinsource', None) == join_source:
+            return
+
+        if join_source:
+            node = self.create_node(self.name, pe.JoinNode,
+                    joinsource=join_source,
+                    joinfield=['in_val1', 'in_val2'])
+        else:
+            node = self.create_node(self.name, pe.Node)
+
+        # carry over the parameters
+        parameters = self._node.inputs.get()
+        for field in ['in_val1', 'in_val2']:
+            parameters.pop(field, None)
+        node.inputs.set(**parameters)
+
+        self.pipeline._replace_node(self, node)
+
 
 ##############################################################################
 # DTI Data grabber
@@ -139,22 +330,28 @@ info = dict(dwi=[['subject_id', 'data']],
             bvecs=[['subject_id','bvecs']],
             bvals=[['subject_id','bvals']])
 
-datasource_iface = nio.DataGrabber(infields=['subject_id'],
-                                               outfields=info.keys())
+def datasource_iface():
+    from nipype_wrapper_custom_interfaces import IndexedDataGrabber
+    iface = IndexedDataGrabber(infields=['subject_id'],
+                               outfields=info.keys())
 
-# currently, earlPipeline doesn't support passing arbitrary python objects as
-# parameters, so the complicated fields like "template_args" etc will be
-# hardcoded here for now (as defaults for interface):
-datasource_iface.inputs.template = "%s/%s"
+    # currently, earlPipeline doesn't support passing arbitrary python objects as
+    # parameters, so the complicated fields like "template_args" etc will be
+    # hardcoded here for now (as defaults for interface):
+    iface.inputs.template = "%s/%s"
 
-datasource_iface.inputs.field_template = dict(dwi='%s/%s.nii.gz')
-datasource_iface.inputs.template_args = info
+    iface.inputs.field_template = dict(dwi='%s/%s.nii.gz')
+    iface.inputs.template_args = info
+    return iface
 
 class DTIDataSource(Unit):
-    interface = datasource_iface
+    interface = LazyInterface(datasource_iface)
     tag = "Sources"
     instance_name_template = "dtisrc"
 
+    # only lists the files, which are hashed by the downstream units anyway
+    use_result_store = False
+
     # only leave "subject_id" as an input port
     hidden_in_ports = ['ignore_exception',
                     'raise_on_empty',
@@ -162,7 +359,10 @@ class DTIDataSource(Unit):
                     'template_args',
                     'template',
                     'base_directory',
-                    'field_template']
+                    'field_template',
+                    'use_index',
+                    'index_max_age',
+                    'index_generation']
 
     # expose system ports as parameters
     ignore_exception = boolean_parameter('ignore_exception', False)
@@ -173,16 +373,25 @@ class DTIDataSource(Unit):
     base_directory = path_parameter('base_directory', '../../fsl_course_data/fdt2')
     sort_filelist = boolean_parameter('sort_filelist', True)
 
+    # look the files up in a cached listing of base_directory
+    use_index = boolean_parameter('use_index', True)
+
+    def prepare_run(self):
+        # the listing is checked for changes once per run, not per subject
+        self._node.inputs.index_generation = self.pipeline.run_id
+
 
 
 ##############################################################################
 # FSL ROI extraction
 ##############################################################################
 
-roi_iface = fsl.ExtractROI()
+def roi_iface():
+    import nipype.interfaces.fsl as fsl
+    return fsl.ExtractROI()
 
 class ROIExtractor(Unit):
-    interface = roi_iface
+    interface = LazyInterface(roi_iface)
     tag = "Processing"
     instance_name_template = "roi"
 
@@ -222,10 +431,12 @@ class ROIExtractor(Unit):
 # FSL Brain Extraction Tool
 ##############################################################################
 
-bet_iface = fsl.BET()
+def bet_iface():
+    import nipype.interfaces.fsl as fsl
+    return fsl.BET()
 
 class BrainExtractor(Unit):
-    interface = bet_iface
+    interface = LazyInterface(bet_iface)
     tag = "Processing"
     instance_name_template = "bet"
 
@@ -270,10 +481,12 @@ class BrainExtractor(Unit):
 # FSL DTI fitting routine
 ##############################################################################
 
-dti_iface = fsl.DTIFit()
+def dti_iface():
+    import nipype.interfaces.fsl as fsl
+    return fsl.DTIFit()
 
 class DTIFitter(Unit):
-    interface = dti_iface
+    interface = LazyInterface(dti_iface)
     tag = "Processing"
     instance_name_template = "dtifit"
 
@@ -305,32 +518,52 @@ class DTIFitter(Unit):
 # Data Sink
 ##############################################################################
 
-datasink_interface = nio.DataSink()
+def datasink_interface():
+    from nipype_wrapper_custom_interfaces import LinkingDataSink
+    return LinkingDataSink()
 
 class DataSink5(Unit):
-    interface = datasink_interface
+    interface = LazyInterface(datasink_interface)
     tag = "Sinks"
     instance_name_template = "datasink"
     redirected_ports_number = {'in': 5, 'out': 0}
 
+    # copies files outside of its working directory: always has to run
+    use_result_store = False
+
+    def pins_upstream(self):
+        # symlinks point into the working directories of the upstream units
+        return self._node.inputs.link_mode == 'symlink'
+
     hidden_in_ports = ['ignore_exception',
                         'strip_dir',
                         'remove_dest_dir',
                         '_outputs',
                         'substitutions',
                         'parameterization',
-                        'regexp_substitutions']
+                        'regexp_substitutions',
+                        'link_mode',
+                        'copy_threads']
 
     ignore_exception = boolean_parameter('ignore_exception', False)
     parameterization = boolean_parameter('parameterization', True)
     remove_dest_dir = boolean_parameter('remove_dest_dir', False)
     base_directory = path_parameter('base_directory', 'test_data')
 
+    # hardlinks and reflinks save the space and time of copying; symlinks
+    # point into the working directory of the workflow and break if it is
+    # cleaned up
+    link_mode = Parameter('link_mode', 'dropdown', str, 'copy',
+            items = ['copy', 'hardlink', 'reflink', 'symlink'])
+    copy_threads = int_parameter('copy_threads', 4)
+
 
 
 
 def get_unit_types():
-    # list of all classes that are visible from the GUI
+    # list of all classes that are visible from the GUI. The classes are
+    # cheap to list: their interfaces are created lazily, and the port lists
+    # are served from the unit types cache (see NipypeWrapperUnitMeta)
     return [PrimitiveSource,
             IterableSource,
             PyFunction2,
@@ -340,3 +573,7 @@ def get_unit_types():
             DTIFitter,
             DataSink5]
 
+def get_unit_type_info():
+    # metadata of the unit types, without creating their interfaces
+    return [cls.get_info() for cls in get_unit_types()]
+
@@ -0,0 +1,334 @@
+"""Shared job queue for running the nodes of a pipeline on several hosts.
+
+The queue is a SQLite database. The 'jobqueue' execution mode (see
+JobQueuePlugin) submits every node as a job, and workers, started on any host
+which sees the database and the pipeline's working directory, pull the jobs
+and run them:
+
+    PYTHONPATH=/path/to/backend python2 nipype_wrapper_jobqueue.py worker --queue /shared/jobs.sqlite
+
+The jobs unpickle nodes, which refer to the classes of the backend modules,
+so the directory of this module has to be on the PYTHONPATH of the workers
+(the local workers started by the plugin get it automatically).
+
+Workers send heartbeats while they run a job. Jobs of workers, which stopped
+sending heartbeats (e.g. a crashed host), and jobs, which exited abnormally,
+are put back into the queue until they have been tried 'max_tries' times.
+Stale heartbeats are detected by watching them for changes with the local
+clock, so the clocks of the hosts don't have to be in sync. Note, that
+SQLite relies on the file locking of the file system, so the database has to
+be on a file system with working locks"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+
+# the default queue database
+default_queue_file = os.path.join(tempfile.gettempdir(), 'earlpipeline',
+        'jobqueue.sqlite')
+
+# seconds between the heartbeats of a worker, and after which a worker
+# without heartbeats is considered dead
+heartbeat_interval = 5.
+heartbeat_timeout = 60.
+
+_schema = """
+create table if not exists jobs (
+    id integer primary key autoincrement,
+    script text not null,
+    node_dir text,
+    name text,
+    status text not null,
+    tries integer not null default 0,
+    max_tries integer not null default 3,
+    worker text,
+    heartbeat real,
+    submitted real,
+    error text);
+create index if not exists jobs_status on jobs (status);
+create table if not exists workers (
+    id text primary key,
+    host text,
+    pid integer,
+    started real,
+    heartbeat real,
+    job integer);
+"""
+
+
+class JobQueue(object):
+    """Job table in a SQLite database. Job statuses: 'pending', 'running',
+    'done', 'failed' and 'cancelled'"""
+
+    def __init__(self, fname=None):
+        self.fname = os.path.abspath(fname or default_queue_file)
+        dirname = os.path.dirname(self.fname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        # the last heartbeat seen of the running jobs and of the workers, and
+        # when (by the local clock) it was first seen: {id: (heartbeat, time)}
+        self._seen_jobs = {}
+        self._seen_workers = {}
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.fname, timeout=60.,
+                isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._db.executescript(_schema)
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def submit(self, script, node_dir=None, name=None, max_tries=3):
+        """Add a job, which runs the shell script 'script'. Returns the job
+        id"""
+        with self._lock:
+            cursor = self._db.execute("insert into jobs (script, node_dir, name, status, max_tries, submitted) "
+                    "values (?, ?, ?, 'pending', ?, ?)",
+                    (script, node_dir, name, max_tries, time.time()))
+            return cursor.lastrowid
+
+    def claim(self, worker_id):
+        """Mark the oldest pending job as running for the worker. Returns
+        (job id, script) or None, if there are no pending jobs"""
+        with self._lock:
+            # 'immediate' takes the write lock right away, so that no two
+            # workers get the same job
+            self._db.execute("begin immediate")
+            try:
+                row = self._db.execute("select id, script from jobs where status = 'pending' "
+                        "order by id limit 1").fetchone()
+                if row:
+                    self._db.execute("update jobs set status = 'running', worker = ?, heartbeat = ?, "
+                            "tries = tries + 1 where id = ?", (worker_id, time.time(), row[0]))
+                self._db.execute("commit")
+            except Exception:
+                self._db.execute("rollback")
+                raise
+        return row
+
+    def finish(self, job_id, returncode, error=None):
+        """Record the exit of a job. Failed jobs are put back into the queue,
+        unless they have been tried 'max_tries' times"""
+        if returncode == 0:
+            self._execute("update jobs set status = 'done', worker = null where id = ?", (job_id,))
+        else:
+            self._execute("update jobs set status = case when tries < max_tries then 'pending' "
+                    "else 'failed' end, worker = null, error = ? where id = ? and status = 'running'",
+                    (error, job_id))
+
+    def heartbeat(self, worker_id, job_id=None):
+        now = time.time()
+        self._execute("update workers set heartbeat = ?, job = ? where id = ?",
+                (now, job_id, worker_id))
+        if job_id is not None:
+            self._execute("update jobs set heartbeat = ? where id = ?", (now, job_id))
+
+    def register_worker(self, worker_id):
+        now = time.time()
+        self._execute("insert or replace into workers (id, host, pid, started, heartbeat) "
+                "values (?, ?, ?, ?, ?)",
+                (worker_id, socket.gethostname(), os.getpid(), now, now))
+
+    def unregister_worker(self, worker_id):
+        self._execute("delete from workers where id = ?", (worker_id,))
+
+    def requeue_stale(self, timeout=None):
+        """Put the running jobs without a heartbeat for 'timeout' seconds
+        back into the queue (or fail them, if they are out of tries), and
+        remove the workers without a heartbeat.
+
+        The heartbeats written by other hosts are not compared with the
+        clock of this one. Instead, a heartbeat is stale, if it hasn't
+        changed for 'timeout' seconds while this queue object was watching
+        it, so only the calls of the same object over time count"""
+        timeout = timeout or heartbeat_timeout
+        now = time.time()
+
+        rows = self._execute("select id, heartbeat from jobs where status = 'running'")
+        for job_id, heartbeat in _stale(self._seen_jobs, rows, now, timeout):
+            # unless a heartbeat has come in the meantime
+            self._execute("update jobs set status = case when tries < max_tries then 'pending' "
+                    "else 'failed' end, worker = null, error = 'worker lost' "
+                    "where id = ? and status = 'running' and heartbeat = ?", (job_id, heartbeat))
+
+        rows = self._execute("select id, heartbeat from workers")
+        for worker_id, heartbeat in _stale(self._seen_workers, rows, now, timeout):
+            self._execute("delete from workers where id = ? and heartbeat = ?", (worker_id, heartbeat))
+
+    def status(self, job_id):
+        """Returns (status, error) of the job"""
+        row = self._execute("select status, error from jobs where id = ?", (job_id,))
+        if not row:
+            raise Exception("Job %d not found in %s" % (job_id, self.fname))
+        return row[0]
+
+    def cancel(self, job_ids):
+        """Cancel the given jobs, if they haven't started yet"""
+        for job_id in job_ids:
+            self._execute("update jobs set status = 'cancelled' where id = ? and status = 'pending'",
+                    (job_id,))
+
+    def workers(self):
+        """Returns the registered workers as a list of dicts"""
+        rows = self._execute("select id, host, pid, started, heartbeat, job from workers")
+        return [dict(zip(('id', 'host', 'pid', 'started', 'heartbeat', 'job'), row))
+                for row in rows]
+
+    def counts(self):
+        """Returns {status: number of jobs}"""
+        return dict(self._execute("select status, count(*) from jobs group by status"))
+
+
+def _stale(seen, rows, now, timeout):
+    """Update 'seen' with the (id, heartbeat) rows and return those, whose
+    heartbeat has been the same for 'timeout' seconds"""
+    current = {}
+    stale = []
+    for row_id, heartbeat in rows:
+        if row_id in seen and seen[row_id][0] == heartbeat:
+            current[row_id] = seen[row_id]
+            if now - seen[row_id][1] >= timeout:
+                stale.append((row_id, heartbeat))
+        else:
+            current[row_id] = (heartbeat, now)
+    seen.clear()
+    seen.update(current)
+    return stale
+
+
+class Worker(object):
+    """Pulls jobs from the queue and runs them one by one, each in its own
+    process. If 'idle_timeout' is given, the worker stops after that many
+    seconds without a job"""
+
+    poll_interval = 1.
+
+    def __init__(self, queue, idle_timeout=None):
+        self.queue = queue
+        self.idle_timeout = idle_timeout
+        self.id = '%s:%d:%d' % (socket.gethostname(), os.getpid(), int(time.time()))
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        self.queue.register_worker(self.id)
+        try:
+            idle_since = time.time()
+            while not self._stopped.is_set():
+                self.queue.requeue_stale()
+                job = self.queue.claim(self.id)
+                if job is None:
+                    if self.idle_timeout is not None and \
+                            time.time() - idle_since > self.idle_timeout:
+                        break
+                    self.queue.heartbeat(self.id)
+                    self._stopped.wait(self.poll_interval)
+                    continue
+
+                self.run_job(*job)
+                idle_since = time.time()
+        finally:
+            self.queue.unregister_worker(self.id)
+
+    def run_job(self, job_id, script):
+        # keep the job's output next to its script
+        log_fname = os.path.splitext(script)[0] + '.log'
+        with open(log_fname, 'a') as log:
+            try:
+                proc = subprocess.Popen(['/bin/sh', script], stdout=log,
+                        stderr=subprocess.STDOUT, cwd=os.path.dirname(script))
+            except OSError as e:
+                self.queue.finish(job_id, -1, str(e))
+                return
+
+            last_heartbeat = 0
+            try:
+                while proc.poll() is None:
+                    if time.time() - last_heartbeat > heartbeat_interval:
+                        self.queue.heartbeat(self.id, job_id)
+                        last_heartbeat = time.time()
+                    time.sleep(min(self.poll_interval, heartbeat_interval))
+            except BaseException:
+                # the worker is being stopped: give the job back
+                proc.terminate()
+                proc.wait()
+                self.queue.finish(job_id, -1, 'worker stopped')
+                raise
+
+        error = None
+        if proc.returncode != 0:
+            error = 'exit code %d, see %s' % (proc.returncode, log_fname)
+        self.queue.finish(job_id, proc.returncode, error)
+
+
+def start_local_workers(n, queue_file=None, idle_timeout=None):
+    """Start 'n' worker processes on this host. Returns the list of
+    subprocess.Popen objects, see 'stop_local_workers'"""
+    module = os.path.abspath(__file__.replace('.pyc', '.py'))
+    cmd = [sys.executable, module,
+            'worker', '--queue', os.path.abspath(queue_file or default_queue_file)]
+    if idle_timeout is not None:
+        cmd += ['--idle-timeout', str(idle_timeout)]
+
+    # the jobs have to import the backend modules (and whatever else this
+    # process could import via its PYTHONPATH)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(module)] +
+            [path for path in os.environ.get('PYTHONPATH', '').split(os.pathsep) if path])
+    return [subprocess.Popen(cmd, env=env) for i in range(n)]
+
+
+def stop_local_workers(procs):
+    for proc in procs:
+        if proc.poll() is None:
+            proc.terminate()
+    for proc in procs:
+        proc.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Job queue of the earlpipeline nipype backend')
+    subparsers = parser.add_subparsers(dest='command')
+
+    worker_parser = subparsers.add_parser('worker', help='pull and run jobs')
+    worker_parser.add_argument('--queue', default=default_queue_file,
+            help='queue database (default: %(default)s)')
+    worker_parser.add_argument('--idle-timeout', type=float,
+            help='stop after that many seconds without a job')
+
+    status_parser = subparsers.add_parser('status', help='show jobs and workers')
+    status_parser.add_argument('--queue', default=default_queue_file,
+            help='queue database (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    queue = JobQueue(args.queue)
+
+    if args.command == 'worker':
+        # terminate like on Ctrl-C, to return the current job to the queue
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+        worker = Worker(queue, args.idle_timeout)
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        for status, n in sorted(queue.counts().items()):
+            sys.stdout.write('%-10s %d\n' % (status, n))
+        for worker in queue.workers():
+            sys.stdout.write('%(id)s  job: %(job)s  last heartbeat: %(heartbeat).0f\n' % worker)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+"""Default locations of the files the nipype backend keeps between runs"""
+
+import os
+import getpass
+import tempfile
+
+
+def user_name():
+    try:
+        return getpass.getuser()
+    except Exception:
+        # no user name in the environment nor in the password database
+        return str(os.getuid())
+
+
+def user_temp_dir(*names):
+    """A path in the temporary directory of the current user,
+    '<tmp>/earlpipeline-<user>/<names>'. Files written there can't collide
+    with, or be blocked by, the ones of other users of the same machine"""
+    return os.path.join(tempfile.gettempdir(), 'earlpipeline-%s' % user_name(), *names)
@@ -0,0 +1,198 @@
+"""Execution plans of the nipype backend pipelines: what a run is going to
+expand to and how long it is expected to take"""
+
+import os
+import json
+import fcntl
+import threading
+
+from nipype_wrapper_profile import critical_path
+from nipype_wrapper_paths import user_temp_dir
+
+# where the per-unit timings of past runs are stored
+timing_history_file = user_temp_dir('timings.json')
+
+# nodes per unit, above which the plan warns about the fan-out
+fan_out_warning = 1000
+
+
+class TimingHistory(object):
+    """Per-node wall times of past runs, stored as JSON. Timings are kept
+    per unit ('pipeline/unit') and per unit type (class name), so that a
+    unit which has never run before is estimated from other units of the
+    same type:
+
+        {'units': {'ppl/bet': {'runs': 3, 'duration': 12.5, 'max_duration': 14.1}},
+         'types': {'BET': {...}}}
+
+    'duration' is a moving average of the mean node duration of a run,
+    'max_duration' the slowest node ever seen.
+
+    Several runs (threads or processes) may update the history at the same
+    time: 'save' applies the updates made since loading to the current
+    contents of the file, under a lock, instead of overwriting it with the
+    state loaded earlier"""
+
+    # weight of the latest run in the moving average
+    smoothing = 0.5
+
+    _lock = threading.Lock()
+
+    def __init__(self, fname=None):
+        self.fname = fname or timing_history_file
+        self.units, self.types = self._load()
+
+        # (table name, key, duration, max_duration) of the updates since
+        # loading, see 'save'
+        self._updates = []
+
+    def _load(self):
+        if os.path.exists(self.fname):
+            try:
+                with open(self.fname) as f:
+                    data = json.load(f)
+                return data.get('units', {}), data.get('types', {})
+            except (IOError, ValueError):
+                # unreadable or broken file, start from scratch
+                pass
+        return {}, {}
+
+    def estimate(self, pipeline_name, unit):
+        """Returns the expected wall time of a single node of the unit, or
+        None if there are no timings for the unit or its type"""
+        stats = self.units.get('%s/%s' % (pipeline_name, unit.name)) or \
+                self.types.get(type(unit).__name__)
+        if stats:
+            return stats['duration']
+        return None
+
+    def update(self, pipeline, profile):
+        """Add the timings of a finished run (a PipelineProfile). The nodes
+        taken from the result store don't count"""
+        for unit_name, stats in profile.by_unit().items():
+            # no node of the unit actually ran
+            if not stats['nodes']:
+                continue
+            duration = stats['duration'] / stats['nodes']
+            unit = pipeline.get_unit(unit_name)
+            for table, key in (('units', '%s/%s' % (pipeline.name, unit_name)),
+                               ('types', type(unit).__name__)):
+                update = (table, key, duration, stats['max_duration'])
+                self._add(getattr(self, table), *update[1:])
+                self._updates.append(update)
+
+    def _add(self, table, key, duration, max_duration):
+        stats = table.get(key)
+        if stats is None:
+            table[key] = {'runs': 1,
+                          'duration': duration,
+                          'max_duration': max_duration}
+        else:
+            stats['runs'] += 1
+            stats['duration'] += self.smoothing * (duration - stats['duration'])
+            stats['max_duration'] = max(stats['max_duration'], max_duration)
+
+    def save(self):
+        """Merge the updates into the file. The threads of this process are
+        serialized by '_lock', other processes by a lock on the file
+        '<fname>.lock'"""
+        dirname = os.path.dirname(self.fname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        with self._lock:
+            with open(self.fname + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    units, types = self._load()
+                    tables = {'units': units, 'types': types}
+                    for table, key, duration, max_duration in self._updates:
+                        self._add(tables[table], key, duration, max_duration)
+
+                    # other processes may read the file concurrently
+                    tmp_fname = '%s.%d.tmp' % (self.fname, os.getpid())
+                    with open(tmp_fname, 'w') as f:
+                        json.dump(tables, f)
+                    os.rename(tmp_fname, self.fname)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+            self.units, self.types = units, types
+            self._updates = []
+
+
+def dependency_levels(upstream):
+    """Returns {unit_name: level} for a DAG given as {unit_name:
+    set(upstream units)}. Sources are at level 0, every other unit one level
+    below its deepest upstream unit"""
+    levels = {}
+    pending = dict(upstream)
+    while pending:
+        ready = [unit_name for unit_name, parents in pending.items()
+                if all(parent in levels for parent in parents)]
+        if not ready:
+            raise Exception("The pipeline graph has a cycle: %s" % ', '.join(sorted(pending)))
+        for unit_name in ready:
+            levels[unit_name] = max([levels[parent] + 1 for parent in pending[unit_name]] or [0])
+            del pending[unit_name]
+    return levels
+
+
+def make_plan(pipeline, n_procs, history=None):
+    """Returns the execution plan of the pipeline for 'n_procs' workers,
+    without running anything. See NipypeWrapperPipeline.plan"""
+    if history is None:
+        history = TimingHistory()
+
+    counts = pipeline.node_counts()
+    upstream = dict((unit.name, pipeline.upstream(unit.name)) for unit in pipeline.units)
+    levels = dependency_levels(upstream)
+
+    # units, which are not going to be re-run, don't cost anything
+    dirty = pipeline.dirty_units()
+
+    units = {}
+    unknown = []
+    for unit in pipeline.units:
+        cached = unit.name not in dirty
+        duration = 0. if cached else history.estimate(pipeline.name, unit)
+        if duration is None:
+            unknown.append(unit.name)
+        units[unit.name] = {'nodes': counts[unit.name],
+                            'level': levels[unit.name],
+                            'cached': cached,
+                            'node_duration': duration,
+                            'work': (duration or 0.) * counts[unit.name]}
+
+    # the nodes of a level can only start, when the previous level is done.
+    # Within a level, the work is spread over the workers, but a level takes
+    # at least as long as its slowest node
+    by_level = [[] for i in range(max(levels.values()) + 1 if levels else 0)]
+    for unit_name, level in levels.items():
+        by_level[level].append(unit_name)
+
+    wall_time = 0.
+    for unit_names in by_level:
+        work = sum(units[unit_name]['work'] for unit_name in unit_names)
+        longest = max([units[unit_name]['node_duration'] or 0. for unit_name in unit_names] or [0.])
+        wall_time += max(longest, work / n_procs)
+
+    weights = dict((unit_name, stats['node_duration'] or 0.)
+            for unit_name, stats in units.items())
+
+    warnings = []
+    for unit_name in sorted(units):
+        if units[unit_name]['nodes'] > fan_out_warning:
+            warnings.append("Unit '%s' expands to %d nodes" % (unit_name, units[unit_name]['nodes']))
+    if unknown:
+        warnings.append("No timings for: %s" % ', '.join(sorted(unknown)))
+
+    return {'n_procs': n_procs,
+            'units': units,
+            'levels': [sorted(unit_names) for unit_names in by_level],
+            'total_nodes': sum(counts.values()),
+            'total_work': sum(stats['work'] for stats in units.values()),
+            'critical_path': critical_path(upstream, weights),
+            'wall_time': wall_time,
+            'unknown': sorted(unknown),
+            'warnings': warnings}
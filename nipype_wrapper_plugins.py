@@ -0,0 +1,94 @@
+"""Custom nipype execution plugins used by the nipype backend"""
+
+import time
+
+from nipype.pipeline.plugins.base import SGELikeBatchManagerBase
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+
+from nipype_wrapper_jobqueue import JobQueue, start_local_workers, stop_local_workers, \
+        heartbeat_interval
+
+
+class CancellableMixin(object):
+    """Mixin for nipype's distributed plugins, which stops submitting nodes
+    as soon as the function 'cancelled' returns True. The nodes, which are
+    already running, are waited for. All the others are dropped without
+    being run, so the scheduler finishes its loop normally, instead of
+    crashing the remaining nodes. The dropped nodes get no status
+    callbacks"""
+
+    cancelled = None
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        if self.cancelled is not None and self.cancelled():
+            # 'done' without 'pending' means finished for the scheduler
+            self.proc_done[:] = True
+            return
+        return super(CancellableMixin, self)._send_procs_to_workers(
+                updatehash=updatehash, graph=graph)
+
+
+class CancellableMultiProcPlugin(CancellableMixin, MultiProcPlugin):
+    pass
+
+
+class JobQueuePlugin(CancellableMixin, SGELikeBatchManagerBase):
+    """Runs the nodes as jobs of a shared queue (see nipype_wrapper_jobqueue),
+    which is served by worker processes on any number of hosts. The status
+    callbacks work as with the other plugins.
+
+    Plugin arguments, in addition to nipype's:
+
+        queue: the queue database (default: jobqueue.default_queue_file)
+        max_tries: number of times a job is tried, if it exits abnormally
+            or its worker is lost (default: 3)
+        local_workers: number of workers started on this host for the
+            duration of the run (default: 0, i.e. the workers are started
+            separately)"""
+
+    def __init__(self, plugin_args=None):
+        plugin_args = plugin_args or {}
+        super(JobQueuePlugin, self).__init__('', plugin_args=plugin_args)
+
+        self._queue = JobQueue(plugin_args.get('queue'))
+        self._max_tries = plugin_args.get('max_tries', 3)
+        self._local_workers = plugin_args.get('local_workers', 0)
+        self._last_requeue = 0
+
+    def run(self, graph, config, updatehash=False):
+        workers = start_local_workers(self._local_workers, self._queue.fname)
+        try:
+            return super(JobQueuePlugin, self).run(graph, config, updatehash=updatehash)
+        finally:
+            # don't leave jobs behind, e.g. if the run was cancelled
+            self._queue.cancel(self._pending.keys())
+            stop_local_workers(workers)
+
+    def _submit_batchtask(self, scriptfile, node):
+        node_dir = node.output_dir()
+        taskid = self._queue.submit(scriptfile, node_dir, node.fullname,
+                self._max_tries)
+        self._pending[taskid] = node_dir
+        return taskid
+
+    def _is_pending(self, taskid):
+        # called for every pending task in every poll cycle, while looking
+        # for lost workers once per heartbeat interval is plenty
+        if time.time() - self._last_requeue > heartbeat_interval:
+            self._queue.requeue_stale()
+            self._last_requeue = time.time()
+        status, error = self._queue.status(taskid)
+        return status in ('pending', 'running')
+
+    def _get_result(self, taskid):
+        if taskid not in self._pending:
+            raise Exception('Task %d not found' % taskid)
+
+        # the job never finished: don't wait for a results file
+        status, error = self._queue.status(taskid)
+        if status in ('failed', 'cancelled'):
+            return {'result': None,
+                    'traceback': 'Job %d %s: %s' % (taskid, status, error),
+                    'hostname': None}
+
+        return super(JobQueuePlugin, self)._get_result(taskid)
@@ -0,0 +1,180 @@
+"""Runtime profiling of the nipype backend pipelines"""
+
+import csv
+import json
+
+
+class PipelineProfile(object):
+    """Runtime statistics of a pipeline run, collected from the runtime
+    information nipype stores in the results of every node. One record is
+    made per node, i.e. per unit and iteration:
+
+        unit: name of the unit
+        iteration: nipype's id of the node copy (differs between iterations)
+        parameterization: iterable values of the node copy, e.g.
+            '_output_val_subj1'
+        status: 'end' or 'exception'
+        stored: whether the outputs were taken from the result store
+            instead of running the node (see ResultStore)
+        duration: wall time in seconds
+        cpu_time: CPU time in seconds, summed up from the samples of the
+            resource monitor
+        cpu_peak_percent: highest CPU usage sampled, in percent of a core
+        mem_peak_gb: peak resident memory in GB
+        output_dir: working directory of the node
+
+    The CPU and memory figures are only available, if the pipeline was run
+    with 'profile_resources' enabled (nipype's resource monitor). Missing
+    values are None. The nodes taken from the result store are left out of
+    the per-unit statistics, their duration says nothing about the unit"""
+
+    fields = ['unit', 'iteration', 'parameterization', 'status', 'stored', 'duration',
+            'cpu_time', 'cpu_peak_percent', 'mem_peak_gb', 'output_dir']
+
+    def __init__(self, pipeline):
+        self.records = []
+
+        # snapshot of the graph, for the critical path
+        self._upstream = dict((unit.name, pipeline.upstream(unit.name))
+                for unit in pipeline.units)
+
+    def record_events(self, events):
+        """Event handler for the StatusDispatcher"""
+        for node, nip_status in events:
+            if nip_status != 'start':
+                self.records.append(self._make_record(node, nip_status))
+
+    def _make_record(self, node, nip_status):
+        record = dict.fromkeys(self.fields)
+        record.update({'unit': node.name,
+                       'iteration': getattr(node, 'itername', node._id),
+                       'parameterization': '/'.join(getattr(node, 'parameterization', [])),
+                       'status': nip_status})
+
+        try:
+            record['output_dir'] = node.output_dir()
+            runtime = node.result.runtime
+        except Exception:
+            # no results, e.g. the node has crashed before running
+            return record
+
+        record['stored'] = getattr(runtime, 'stored', None) is not None
+        record['duration'] = getattr(runtime, 'duration', None)
+        record['mem_peak_gb'] = getattr(runtime, 'mem_peak_gb', None)
+        record['cpu_peak_percent'] = getattr(runtime, 'cpu_percent', None)
+        record['cpu_time'] = _cpu_time(getattr(runtime, 'prof_dict', None))
+
+        return record
+
+    def by_unit(self):
+        """Returns {unit_name: stats} with the records aggregated per unit:
+
+            nodes: number of recorded nodes, which actually ran
+            stored: number of nodes taken from the result store
+            duration: total wall time of all nodes
+            max_duration: wall time of the slowest node
+            cpu_time: total CPU time
+            mem_peak_gb: maximal peak memory of a node"""
+        units = {}
+        for record in self.records:
+            stats = units.setdefault(record['unit'], {'nodes': 0,
+                                                      'stored': 0,
+                                                      'duration': 0.,
+                                                      'max_duration': 0.,
+                                                      'cpu_time': 0.,
+                                                      'mem_peak_gb': 0.})
+            if record['stored']:
+                stats['stored'] += 1
+                continue
+            stats['nodes'] += 1
+            stats['duration'] += record['duration'] or 0.
+            stats['max_duration'] = max(stats['max_duration'], record['duration'] or 0.)
+            stats['cpu_time'] += record['cpu_time'] or 0.
+            stats['mem_peak_gb'] = max(stats['mem_peak_gb'], record['mem_peak_gb'] or 0.)
+
+        return units
+
+    def sorted(self, key='duration'):
+        """Returns a list of (unit_name, stats) pairs, most expensive first.
+        'key' is one of the stats fields of 'by_unit'"""
+        return sorted(self.by_unit().items(), key=lambda item: item[1][key],
+                reverse=True)
+
+    def critical_path(self):
+        """Returns {'units': [...], 'duration': float}: the chain of units,
+        which determined the wall time of the run. Every unit is weighted by
+        its slowest node, since the iterations of a unit may run in
+        parallel"""
+        weights = dict((unit_name, stats['max_duration'])
+                for unit_name, stats in self.by_unit().items())
+        return critical_path(self._upstream, weights)
+
+    def summary(self):
+        return {'units': self.by_unit(),
+                'critical_path': self.critical_path()}
+
+    def to_json(self, fname=None):
+        """Returns the records and the summary as a JSON string, or writes
+        them to a file"""
+        data = dict(self.summary(), records=self.records)
+        if fname is None:
+            return json.dumps(data)
+        with open(fname, 'w') as f:
+            json.dump(data, f)
+
+    def to_csv(self, fname):
+        """Write the records to a CSV file"""
+        with open(fname, 'wb') as f:
+            writer = csv.DictWriter(f, self.fields)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+
+def _cpu_time(samples):
+    """CPU seconds from the samples of nipype's resource monitor. Every
+    sample is the average CPU usage (in percent) since the previous one.
+    None, if there are no samples"""
+    if not samples or not samples.get('time'):
+        return None
+    times = samples['time']
+    cpus = samples['cpus']
+    return sum(cpus[i] / 100. * (times[i] - times[i - 1])
+            for i in range(1, len(times)))
+
+
+def critical_path(upstream, weights):
+    """Longest path through a DAG, given as {unit_name: set(upstream units)},
+    where every unit has a cost of weights.get(unit_name, 0). Returns
+    {'units': [...], 'duration': float}"""
+    # topological order (Kahn's algorithm)
+    downstream = dict((unit_name, []) for unit_name in upstream)
+    for unit_name, parents in upstream.items():
+        for parent in parents:
+            downstream[parent].append(unit_name)
+    pending = dict((unit_name, len(parents)) for unit_name, parents in upstream.items())
+    order = [unit_name for unit_name, n in pending.items() if n == 0]
+    for unit_name in order:
+        for child in downstream[unit_name]:
+            pending[child] -= 1
+            if pending[child] == 0:
+                order.append(child)
+
+    finish = {} # unit_name: (finish time, predecessor on the path)
+    for unit_name in order:
+        start, predecessor = 0., None
+        for parent in upstream[unit_name]:
+            if finish[parent][0] > start:
+                start, predecessor = finish[parent][0], parent
+        finish[unit_name] = (start + weights.get(unit_name, 0.), predecessor)
+
+    if not finish:
+        return {'units': [], 'duration': 0.}
+
+    last = max(finish, key=lambda unit_name: finish[unit_name][0])
+    duration = finish[last][0]
+    path = []
+    while last is not None:
+        path.append(last)
+        last = finish[last][1]
+
+    return {'units': path[::-1], 'duration': duration}
@@ -0,0 +1,192 @@
+"""Removal of intermediate outputs during a run of a nipype backend pipeline"""
+
+import os
+import shutil
+
+from nipype.pipeline.engine.utils import expand_iterables
+
+try:
+    from nipype.pipeline.engine.utils import _get_valid_pathstr
+except ImportError:
+    _get_valid_pathstr = str
+
+
+def _dir_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fname in filenames:
+            fname = os.path.join(dirpath, fname)
+            if not os.path.islink(fname):
+                size += os.path.getsize(fname)
+    return size
+
+
+def _iteration_tokens(node):
+    """The parameterization strings nipype gives the copies of a node with
+    iterables, one per copy"""
+    iterables = node.iterables
+    if isinstance(iterables, tuple):
+        iterables = [iterables]
+    iterables = dict((field, lambda values=values: values) for field, values in iterables)
+
+    tokens = []
+    for params in expand_iterables(iterables, getattr(node, 'synchronize', False)):
+        token = ''
+        for field, value in sorted(params.items()):
+            token = '%s_%s_%s' % (token, _get_valid_pathstr(field), _get_valid_pathstr(value))
+        tokens.append(token)
+    return tokens
+
+
+class IntermediateCleaner(object):
+    """Event handler for the StatusDispatcher, which deletes the working
+    directory of a node as soon as all the nodes consuming its outputs have
+    finished. This way the disk usage follows the nodes, which are still
+    needed, instead of growing with the whole graph.
+
+    The nodes are matched by their iterations: a node copied for the
+    iterables of the units upstream of it (e.g. one per subject) only waits
+    for the nodes of the consuming units with the same iterable values, so
+    every iteration's directory goes as soon as its own consumers are done.
+    Nodes behind a join node wait for all the consumer's nodes the join
+    collects them into.
+
+    Kept are:
+        - the outputs of units without downstream units (the results)
+        - the units pinned by the user ('pipeline.pinned_units')
+        - the direct upstream units of units, which reference the files of
+          their inputs after they've finished (see
+          NipypeWrapperUnit.pins_upstream, e.g. a DataSink5 creating
+          symlinks)
+
+    Units with 'passes_through_files' may output the paths they got as
+    inputs, so their upstream units are kept until the consumers of the
+    pass-through unit have finished as well. The directories of failed
+    nodes, and of the nodes feeding them, are kept for inspection"""
+
+    def __init__(self, pipeline, progress):
+        self.pipeline = pipeline
+        self.progress = progress
+
+        # units with removed node directories and the number of bytes freed
+        self.removed = []
+        self.freed_bytes = 0
+
+        # the units, which have to finish before the outputs of a unit may go
+        self._consumers = {}
+        for unit in pipeline.units:
+            consumers = set()
+            front = list(pipeline.downstream(unit.name))
+            while front:
+                unit_name = front.pop()
+                if unit_name in consumers:
+                    continue
+                consumers.add(unit_name)
+                if pipeline.get_unit(unit_name).passes_through_files:
+                    front.extend(pipeline.downstream(unit_name))
+            self._consumers[unit.name] = consumers
+
+        pinned = set(pipeline.pinned_units)
+        for unit in pipeline.units:
+            if unit.pins_upstream():
+                pinned.update(self._providers(unit.name))
+        self._candidates = set(unit_name for unit_name, consumers in self._consumers.items()
+                if consumers and unit_name not in pinned)
+
+        # the parameterization strings of the iterations of every unit with
+        # iterables. If two of them can't be told apart, the nodes expanded
+        # by them wait for all the nodes of their consumers
+        self._sources = pipeline.iterable_sources()
+        self._tokens = {}
+        lengths = {}
+        for sources in self._sources.values():
+            for source_name in sources:
+                if source_name not in self._tokens:
+                    tokens = _iteration_tokens(pipeline.get_unit(source_name)._node)
+                    self._tokens[source_name] = set(tokens)
+                    lengths[source_name] = len(tokens)
+        ambiguous = set(source_name for source_name, tokens in self._tokens.items()
+                if any(tokens & other for other_name, other in self._tokens.items()
+                        if other_name != source_name))
+
+        # (unit, consumer): the sources of the iterations the consumer's
+        # nodes have to match, and the number of its nodes matching an
+        # iteration of the unit
+        self._matching = {}
+        self._units_consumed_by = dict((unit.name, []) for unit in pipeline.units)
+        for unit_name in self._candidates:
+            for consumer in self._consumers[unit_name]:
+                shared = sorted(self._sources[unit_name] & self._sources[consumer])
+                if ambiguous.intersection(shared):
+                    shared = []
+                expected = progress[consumer]['total']
+                for source_name in shared:
+                    expected //= lengths[source_name] or 1
+                self._matching[(unit_name, consumer)] = (shared, expected)
+                self._units_consumed_by[consumer].append(unit_name)
+
+        # finished consumer nodes by (unit, consumer, iteration)
+        self._consumed = {}
+
+        # finished nodes of the candidates, waiting for their consumers:
+        # {unit_name: [(parameterization, output directory)]}
+        self._waiting = dict((unit_name, []) for unit_name in self._candidates)
+
+    def _providers(self, unit_name):
+        """Units, whose files may reach the unit as inputs"""
+        providers = set()
+        front = list(self.pipeline.upstream(unit_name))
+        while front:
+            upstream_name = front.pop()
+            if upstream_name in providers:
+                continue
+            providers.add(upstream_name)
+            if self.pipeline.get_unit(upstream_name).passes_through_files:
+                front.extend(self.pipeline.upstream(upstream_name))
+        return providers
+
+    def _iteration(self, parameterization, sources):
+        """The parameterization strings of a node for the given sources"""
+        return tuple(tuple(sorted(parameterization & self._tokens[source_name]))
+                for source_name in sources)
+
+    def _done(self, unit_name, parameterization):
+        for consumer in self._consumers[unit_name]:
+            shared, expected = self._matching[(unit_name, consumer)]
+            key = (unit_name, consumer, self._iteration(parameterization, shared))
+            if self._consumed.get(key, 0) < expected:
+                return False
+        return True
+
+    def record_events(self, events):
+        for node, nip_status in events:
+            if nip_status != 'end':
+                continue
+            parameterization = set(getattr(node, 'parameterization', None) or [])
+
+            for unit_name in self._units_consumed_by[node.name]:
+                shared, expected = self._matching[(unit_name, node.name)]
+                key = (unit_name, node.name, self._iteration(parameterization, shared))
+                self._consumed[key] = self._consumed.get(key, 0) + 1
+
+            if node.name in self._waiting:
+                try:
+                    self._waiting[node.name].append((parameterization, node.output_dir()))
+                except Exception:
+                    pass
+
+        for unit_name, nodes in self._waiting.items():
+            waiting = []
+            for parameterization, output_dir in nodes:
+                if self._done(unit_name, parameterization):
+                    self._remove(unit_name, output_dir)
+                else:
+                    waiting.append((parameterization, output_dir))
+            self._waiting[unit_name] = waiting
+
+    def _remove(self, unit_name, output_dir):
+        if os.path.isdir(output_dir):
+            self.freed_bytes += _dir_size(output_dir)
+            shutil.rmtree(output_dir, ignore_errors=True)
+        if unit_name not in self.removed:
+            self.removed.append(unit_name)
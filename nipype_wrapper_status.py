@@ -0,0 +1,103 @@
+"""Asynchronous propagation of node statuses to the units of a pipeline"""
+
+import Queue
+import threading
+
+from earlpipeline.backends import base
+
+
+class StatusDispatcher(object):
+    """Collects nipype's node status events of a running pipeline and
+    propagates them to the units in a separate thread.
+
+    Nipype's status callback only puts the events on a queue (see 'push'), so
+    that the scheduler never waits for the GUI. Every 'interval' seconds, the
+    queued events are coalesced per unit: for every unit the numbers of
+    started, finished and failed nodes (iterations) are updated, and the unit
+    status is set only if it actually changed. The counts are available in
+    'progress' and as 'unit.progress', e.g.
+
+        {'running': 3, 'finished': 37, 'failed': 0, 'total': 120}
+
+    where 'total' is the expected number of nodes of the unit after the
+    iterables expansion (see NipypeWrapperPipeline.node_counts)"""
+
+    def __init__(self, pipeline, interval=0.5):
+        self.pipeline = pipeline
+        self.interval = interval
+
+        # functions f(events), receiving every flushed batch of raw
+        # (node, nip_status) events
+        self.event_handlers = []
+
+        self.progress = {}
+        for unit_name, total in pipeline.node_counts().items():
+            self.progress[unit_name] = {'running': 0,
+                                        'finished': 0,
+                                        'failed': 0,
+                                        'total': total}
+
+        self._statuses = {}
+        self._queue = Queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._loop,
+                name='status-%s' % pipeline.name)
+        self._thread.daemon = True
+
+    def push(self, node, nip_status):
+        """Queue a status event. Called from nipype's scheduler thread"""
+        self._queue.put((node, nip_status))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Stop the dispatcher thread and flush the remaining events"""
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        events = []
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        if not events:
+            return
+
+        changed = set()
+        for node, nip_status in events:
+            progress = self.progress[node.name]
+            if nip_status == 'start':
+                progress['running'] += 1
+            else:
+                progress['running'] = max(0, progress['running'] - 1)
+                if nip_status == 'end':
+                    progress['finished'] += 1
+                else:
+                    progress['failed'] += 1
+            changed.add(node.name)
+
+        for unit_name in changed:
+            progress = self.progress[unit_name]
+            if progress['failed']:
+                status = base.tools.Status.FAILED
+            elif progress['finished'] >= progress['total'] and not progress['running']:
+                status = base.tools.Status.FINISHED
+            else:
+                status = base.tools.Status.RUNNING
+
+            self.pipeline.get_unit(unit_name).progress = dict(progress)
+            if self._statuses.get(unit_name) != status:
+                self._statuses[unit_name] = status
+                self.pipeline._set_status(unit_name, status)
+
+        for handler in self.event_handlers:
+            handler(events)
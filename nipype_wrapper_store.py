@@ -0,0 +1,336 @@
+"""Result store shared between pipelines.
+
+nipype only finds the results of a node in the working directory of its own
+workflow. The ResultStore keeps the outputs of the executed nodes in a
+central directory, keyed by the interface class, the inputs and the contents
+of the input files, so that a node with the same interface and inputs in any
+other pipeline gets its outputs from the store instead of running again."""
+
+import os
+import time
+import shutil
+import pickle
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+import nipype.pipeline.engine as pe
+from nipype.interfaces.base import InterfaceResult, Bunch, isdefined
+from nipype.utils.filemanip import get_related_files
+
+try:
+    from nipype.pipeline.engine.utils import save_resultfile
+except ImportError:
+    # older nipype versions save the results via Node._save_results
+    save_resultfile = None
+
+# the default store directory
+default_store_dir = os.path.join(tempfile.gettempdir(), 'earlpipeline', 'store')
+
+_schema = """
+create table if not exists entries (
+    key text primary key,
+    unit_type text,
+    size integer not null,
+    created real,
+    last_used real);
+create table if not exists stats (
+    unit_type text primary key,
+    hits integer not null default 0,
+    misses integer not null default 0);
+"""
+
+# placeholder for the node directory in the stored output paths
+_outdir_marker = '<outdir>'
+
+# md5 of the files, by (path, size, mtime)
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+def _content_hash(fname):
+    # not imported with the module, the custom interfaces pull in nipype's
+    # io and utility interfaces
+    from nipype_wrapper_custom_interfaces import file_md5
+
+    st = os.stat(fname)
+    key = (fname, st.st_size, st.st_mtime)
+    with _file_hashes_lock:
+        if key in _file_hashes:
+            return _file_hashes[key]
+    digest = file_md5(fname)
+    with _file_hashes_lock:
+        _file_hashes[key] = digest
+    return digest
+
+
+def _key_value(value):
+    """Input value, with the paths of files replaced by their name and the
+    hash of their contents (and of their related files, e.g. an .hdr)"""
+    if isinstance(value, (list, tuple)):
+        return [_key_value(item) for item in value]
+    if isinstance(value, dict):
+        return sorted((k, _key_value(v)) for k, v in value.items())
+    if isinstance(value, basestring) and os.path.isfile(value):
+        hashes = [_content_hash(fname) for fname in
+                get_related_files(value, include_this_file=True)
+                if os.path.isfile(fname)]
+        return ('file', os.path.basename(value), hashes)
+    return value
+
+
+def _map_paths(value, func):
+    """Apply func to all the strings inside the output value"""
+    if isinstance(value, list):
+        return [_map_paths(item, func) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_map_paths(item, func) for item in value)
+    if isinstance(value, basestring):
+        # keep subclasses, e.g. ArrayRef
+        return type(value)(func(value))
+    return value
+
+
+class ResultStore(object):
+    """Content-addressed store of node outputs in 'root', using at most
+    'budget_gb' of disk space. When the budget is exceeded, the least
+    recently used results are evicted.
+
+    Only nodes, whose output files all lie in their own working directory,
+    are stored. The files are hard-linked into the store and back, if
+    possible. Hits and misses are counted per unit type, see 'stats'"""
+
+    def __init__(self, root=None, budget_gb=50.):
+        self.root = os.path.abspath(root or default_store_dir)
+        self.budget_gb = budget_gb
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        with self._connect() as db:
+            db.executescript(_schema)
+
+    def _connect(self):
+        # a new connection per operation: the store is used from the
+        # scheduler threads and from worker processes
+        return sqlite3.connect(os.path.join(self.root, 'index.sqlite'), timeout=60.)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def make_key(self, interface):
+        """Key of the interface with its current inputs"""
+        inputs = interface.inputs
+        values = []
+        for name, value in sorted(inputs.get_traitsfree().items()):
+            if inputs.trait(name).nohash or not isdefined(value):
+                continue
+            values.append((name, _key_value(value)))
+
+        cls = type(interface)
+        return hashlib.sha1(repr(('%s.%s' % (cls.__module__, cls.__name__),
+                values))).hexdigest()
+
+    def get(self, key, unit_type, outdir):
+        """Put the stored output files into 'outdir' and return the
+        outputs dict, or None if the key is not in the store"""
+        with self._connect() as db:
+            found = db.execute("select key from entries where key = ?", (key,)).fetchone()
+            if found:
+                db.execute("update entries set last_used = ? where key = ?", (time.time(), key))
+
+        outputs = None
+        if found:
+            try:
+                outputs = self._restore(key, outdir)
+            except (IOError, OSError):
+                # evicted in the meantime
+                outputs = None
+
+        self._count(unit_type, outputs is not None)
+        return outputs
+
+    def _restore(self, key, outdir):
+        entry_dir = self._entry_dir(key)
+        with open(os.path.join(entry_dir, 'outputs.pkl'), 'rb') as f:
+            outputs = pickle.load(f)
+
+        for dirpath, dirnames, filenames in os.walk(os.path.join(entry_dir, 'files')):
+            rel = os.path.relpath(dirpath, os.path.join(entry_dir, 'files'))
+            dst_dir = os.path.normpath(os.path.join(outdir, rel))
+            if not os.path.isdir(dst_dir):
+                os.makedirs(dst_dir)
+            for fname in filenames:
+                _link_or_copy(os.path.join(dirpath, fname), os.path.join(dst_dir, fname))
+
+        return dict((name, _map_paths(value, lambda s: s.replace(_outdir_marker, outdir)))
+                for name, value in outputs.items())
+
+    def put(self, key, unit_type, outdir, outputs):
+        """Store the outputs dict of a node, which ran in 'outdir'. Returns
+        False, if the outputs refer to files outside of 'outdir'"""
+        outdir = os.path.abspath(outdir)
+        files = set()
+        def collect(s):
+            if os.path.isfile(s):
+                path = os.path.abspath(s)
+                if not path.startswith(outdir + os.sep):
+                    raise ValueError(path)
+                files.update(fname for fname in get_related_files(path, include_this_file=True)
+                        if os.path.isfile(fname))
+            elif os.path.isdir(s):
+                # only single files are stored
+                raise ValueError(s)
+            return s.replace(outdir, _outdir_marker)
+        try:
+            outputs = dict((name, _map_paths(value, collect))
+                    for name, value in outputs.items())
+        except ValueError:
+            return False
+
+        entry_dir = self._entry_dir(key)
+        tmp_dir = '%s.%d.%d.tmp' % (entry_dir, os.getpid(), threading.current_thread().ident)
+        size = 0
+        for fname in files:
+            dst = os.path.join(tmp_dir, 'files', os.path.relpath(fname, outdir))
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            _link_or_copy(fname, dst)
+            size += os.path.getsize(fname)
+        if not os.path.isdir(tmp_dir):
+            os.makedirs(tmp_dir)
+        with open(os.path.join(tmp_dir, 'outputs.pkl'), 'wb') as f:
+            pickle.dump(outputs, f, pickle.HIGHEST_PROTOCOL)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # stored concurrently by another node
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return True
+
+        now = time.time()
+        with self._connect() as db:
+            db.execute("insert or replace into entries (key, unit_type, size, created, last_used) "
+                    "values (?, ?, ?, ?, ?)", (key, unit_type, size, now, now))
+        self.evict()
+        return True
+
+    def evict(self, budget_gb=None):
+        """Remove the least recently used results, until the store fits into
+        the budget"""
+        if budget_gb is None:
+            budget_gb = self.budget_gb
+        budget = budget_gb * (1 << 30)
+        with self._connect() as db:
+            total = db.execute("select coalesce(sum(size), 0) from entries").fetchone()[0]
+            if total <= budget:
+                return
+            evicted = []
+            for key, size in db.execute("select key, size from entries order by last_used"):
+                if total <= budget:
+                    break
+                evicted.append(key)
+                total -= size
+            db.executemany("delete from entries where key = ?", [(key,) for key in evicted])
+
+        for key in evicted:
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def _count(self, unit_type, hit):
+        column = 'hits' if hit else 'misses'
+        with self._connect() as db:
+            db.execute("insert or ignore into stats (unit_type) values (?)", (unit_type,))
+            db.execute("update stats set %s = %s + 1 where unit_type = ?" % (column, column),
+                    (unit_type,))
+
+    def stats(self):
+        """Returns {unit_type: {'hits': n, 'misses': n}}"""
+        with self._connect() as db:
+            rows = db.execute("select unit_type, hits, misses from stats").fetchall()
+        return dict((unit_type, {'hits': hits, 'misses': misses})
+                for unit_type, hits, misses in rows)
+
+    def size_gb(self):
+        with self._connect() as db:
+            return db.execute("select coalesce(sum(size), 0) from entries").fetchone()[0] / float(1 << 30)
+
+    def clear(self):
+        with self._connect() as db:
+            keys = [row[0] for row in db.execute("select key from entries")]
+            db.execute("delete from entries")
+            db.execute("delete from stats")
+        for key in keys:
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+
+def _link_or_copy(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class StoredNodeMixin(object):
+    """Looks the node up in 'result_store' before running it, and stores
+    the results after running it. 'result_store_type' is the name the hits
+    and misses are counted under"""
+
+    result_store = None
+    result_store_type = None
+
+    def _run_command(self, execute, copyfiles=True):
+        store = self.result_store
+        if not execute or store is None:
+            return super(StoredNodeMixin, self)._run_command(execute, copyfiles)
+
+        if isinstance(self, pe.JoinNode):
+            # the key depends on the joined inputs
+            self._collate_join_field_inputs()
+
+        key = store.make_key(self._interface)
+        outdir = self.output_dir()
+        outputs = store.get(key, self.result_store_type, outdir)
+        if outputs is None:
+            result = super(StoredNodeMixin, self)._run_command(execute, copyfiles)
+            if result.outputs:
+                store.put(key, self.result_store_type, outdir, result.outputs.trait_get())
+            return result
+
+        result = InterfaceResult(interface=self._interface.__class__,
+                runtime=Bunch(cwd=outdir, returncode=0, duration=0.,
+                    environ=dict(os.environ), stored=key),
+                inputs=self._interface.inputs.get_traitsfree(),
+                outputs=self._interface._outputs())
+        result.outputs.trait_set(**outputs)
+
+        # let nipype find the results in the working directory next time
+        if save_resultfile:
+            save_resultfile(result, outdir, self.name)
+        else:
+            self._save_results(result, outdir)
+        return result
+
+
+class StoredNode(StoredNodeMixin, pe.Node):
+    pass
+
+class StoredJoinNode(StoredNodeMixin, pe.JoinNode):
+    pass
+
+# node class: the same class with the store lookup
+stored_node_classes = {pe.Node: StoredNode,
+                       pe.JoinNode: StoredJoinNode}
+_plain_node_classes = dict((stored, plain) for plain, stored in stored_node_classes.items())
+
+
+def use_result_store(node, store, unit_type):
+    """Switch the node to its class with (or, if store is None, without) the
+    store lookup"""
+    plain = _plain_node_classes.get(type(node), type(node))
+    if store is None:
+        node.__class__ = plain
+    elif plain in stored_node_classes:
+        node.__class__ = stored_node_classes[plain]
+        node.result_store = store
+        node.result_store_type = unit_type
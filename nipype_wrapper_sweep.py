@@ -0,0 +1,175 @@
+"""Parameter sweeps over the nipype backend pipelines"""
+
+import itertools
+
+from earlpipeline.backends import base
+
+try:
+    from nipype.pipeline.engine.utils import _get_valid_pathstr
+except ImportError:
+    _get_valid_pathstr = str
+
+# pipeline settings, which are carried over to the swept copy
+_copied_settings = ['execution_mode', 'plugin_args', 'status_interval',
+        'profile_resources', 'record_timings', 'result_store',
+        'cleanup_intermediates']
+
+
+class ParameterSweep(object):
+    """Runs a pipeline for all combinations of the given parameter values,
+    e.g.
+
+        sweep = ParameterSweep(ppl, {'bet.frac': [0.3, 0.5, 0.7],
+                                     'roi.t_min': [0, 5]})
+        sweep.run()
+        for record in sweep.results():
+            print record['variant'], record['unit'], record['output_dir']
+
+    The pipeline itself is not modified. The sweep works on a single copy of
+    it, where the swept parameters become nipype iterables of their units.
+    So nipype expands the graph: the units upstream of the swept ones run
+    only once for all variants (and share their results with the runs of the
+    original pipeline), the units downstream run once per variant, and all
+    of them run concurrently, as far as the execution mode of the pipeline
+    allows.
+
+    The sweep and the pipeline can't run at the same time, the one started
+    second fails as with a second run of the same pipeline.
+
+    Units, which already have iterables (e.g. an IterableSource), and
+    batch-mode PyFunction2 units downstream of a swept unit can't be
+    combined with a sweep"""
+
+    def __init__(self, pipeline, grid):
+        # the copy runs in the same working directory, under the same name,
+        # so it must not run at the same time as the pipeline: they share
+        # the run lock
+        self.pipeline = type(pipeline).from_state(pipeline.get_state())
+        self.pipeline._workflow.base_dir = pipeline._workflow.base_dir
+        self.pipeline._run_lock = pipeline._run_lock
+        for setting in _copied_settings:
+            setattr(self.pipeline, setting, getattr(pipeline, setting))
+        self.pipeline.pinned_units = set(pipeline.pinned_units)
+
+        # {unit_name: {parameter: [values]}}
+        self.grid = {}
+        for key, values in grid.items():
+            unit_name, _, parameter = key.partition('.')
+            if not len(values):
+                raise Exception("No values to sweep for '%s'" % key)
+            self.grid.setdefault(unit_name, {})[parameter] = \
+                    self._convert(unit_name, parameter, values)
+
+        self._check()
+
+        # {unit_name: [(parameterization token, {parameter: value})]}
+        self._tokens = {}
+        for unit_name, parameters in self.grid.items():
+            node = self.pipeline.get_unit(unit_name)._node
+            node.iterables = sorted(parameters.items())
+            self._tokens[unit_name] = [(self._token(assignment), assignment)
+                    for assignment in _product(parameters)]
+
+        tokens = [token for unit_tokens in self._tokens.values()
+                for token, assignment in unit_tokens]
+        if len(set(tokens)) < len(tokens):
+            raise Exception("The variants of different units can't be told apart, sweep parameters with different names or values")
+
+    def _convert(self, unit_name, parameter, values):
+        """Returns the values converted and validated like with
+        NipypeWrapperUnit.set_parameters"""
+        if unit_name not in [unit.name for unit in self.pipeline.units]:
+            raise Exception("Unit '%s' is not in pipeline '%s'" % (unit_name, self.pipeline.name))
+        unit = self.pipeline.get_unit(unit_name)
+        if not isinstance(getattr(type(unit), parameter, None), base.Parameter):
+            raise Exception("Unit '%s' has no parameter '%s'" % (unit_name, parameter))
+        if parameter in getattr(unit, 'redirection_parameters', {}):
+            raise Exception("Port redirections can't be swept: %s.%s" % (unit_name, parameter))
+
+        original = unit.get_parameter(parameter)
+        converted = []
+        try:
+            for value in values:
+                unit.set_parameters({parameter: value})
+                converted.append(unit.get_parameter(parameter))
+        finally:
+            # the original value may be undefined, so it is not converted
+            unit._apply_parameters({parameter: original})
+        return converted
+
+    def _check(self):
+        for unit_name in self.grid:
+            if self.pipeline.get_unit(unit_name)._node.iterables:
+                raise Exception("Unit '%s' already has iterables and can't be swept" % unit_name)
+
+        downstream = self.pipeline._closure(self.grid.keys(), self.pipeline.downstream)
+        for unit_name in downstream:
+            if getattr(self.pipeline.get_unit(unit_name)._node.inputs, 'batch_mode', False):
+                raise Exception("Unit '%s' runs in batch mode, which can't be combined with a sweep" % unit_name)
+
+    def _token(self, assignment):
+        """The parameterization string nipype gives the nodes of this
+        assignment of a unit's iterables"""
+        token = ''
+        for parameter, value in sorted(assignment.items()):
+            token = '%s_%s_%s' % (token, _get_valid_pathstr(parameter), _get_valid_pathstr(value))
+        return token
+
+    def variants(self):
+        """All combinations of the swept values, as {'unit.parameter':
+        value} dicts"""
+        flat = {}
+        for unit_name, parameters in self.grid.items():
+            for parameter, values in parameters.items():
+                flat['%s.%s' % (unit_name, parameter)] = values
+        return _product(flat)
+
+    def plan(self, n_procs=None):
+        """Execution plan of the sweep, see NipypeWrapperPipeline.plan"""
+        return self.pipeline.plan(n_procs)
+
+    def run(self, **kwargs):
+        """Run all variants. Accepts the arguments of
+        NipypeWrapperPipeline.run. Returns 'results'"""
+        self.pipeline.run(**kwargs)
+        return self.results()
+
+    def run_async(self, **kwargs):
+        return self.pipeline.run_async(**kwargs)
+
+    def variant_of(self, parameterization):
+        """Returns the swept values ({'unit.parameter': value}) a node with
+        the given parameterization (see PipelineProfile) was run with. The
+        nodes shared by several variants only get the values of the swept
+        units upstream of them"""
+        tokens = set(parameterization.split('/'))
+        variant = {}
+        for unit_name, unit_tokens in self._tokens.items():
+            for token, assignment in unit_tokens:
+                if token in tokens:
+                    for parameter, value in assignment.items():
+                        variant['%s.%s' % (unit_name, parameter)] = value
+                    break
+        return variant
+
+    def results(self):
+        """The profile records of the last run (see PipelineProfile), each
+        with an additional 'variant' field, see 'variant_of'"""
+        if self.pipeline.profile is None:
+            return []
+        return [dict(record, variant=self.variant_of(record['parameterization'] or ''))
+                for record in self.pipeline.profile.records]
+
+    def outputs(self, unit_name):
+        """Returns a list of (variant, output directory) pairs for the nodes
+        of the unit in the last run"""
+        return [(record['variant'], record['output_dir'])
+                for record in self.results()
+                if record['unit'] == unit_name and record['status'] == 'end']
+
+
+def _product(values):
+    """All combinations of {key: [values]}, as a list of {key: value}"""
+    keys = sorted(values)
+    return [dict(zip(keys, combination))
+            for combination in itertools.product(*[values[key] for key in keys])]
@@ -0,0 +1,123 @@
+"""Tests of the shared job queue (nipype_wrapper_jobqueue). They don't need
+nipype: the jobs are plain shell scripts"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nipype_wrapper_jobqueue as jobqueue
+
+
+def _wait_for(condition, timeout=30.):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = jobqueue.JobQueue(os.path.join(self.tmp_dir, 'jobs.sqlite'))
+        self.workers = []
+
+    def tearDown(self):
+        jobqueue.stop_local_workers(self.workers)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _script(self, name, body):
+        fname = os.path.join(self.tmp_dir, name + '.sh')
+        with open(fname, 'w') as f:
+            f.write(body)
+        return fname
+
+    def test_local_workers(self):
+        # slow enough jobs, so that both workers get one
+        job_ids = [self.queue.submit(self._script('job%d' % i,
+                    'sleep 1\necho $PPID > %s/job%d.out\n' % (self.tmp_dir, i)))
+                for i in range(4)]
+
+        # fails the first time only
+        flag = os.path.join(self.tmp_dir, 'flag')
+        retried = self.queue.submit(self._script('retried',
+                'if [ -e %s ]; then exit 0; fi\ntouch %s\nexit 1\n' % (flag, flag)),
+                max_tries=2)
+
+        self.workers = jobqueue.start_local_workers(2, self.queue.fname, idle_timeout=5)
+        self.assertTrue(_wait_for(lambda: len(self.queue.workers()) == 2))
+        self.assertTrue(_wait_for(lambda: self.queue.counts().get('done') == 5))
+
+        for job_id in job_ids + [retried]:
+            self.assertEqual(self.queue.status(job_id)[0], 'done')
+        tries = self.queue._execute("select tries from jobs where id = ?", (retried,))[0][0]
+        self.assertEqual(tries, 2)
+
+        # the jobs ran in both workers
+        pids = set()
+        for i in range(4):
+            with open(os.path.join(self.tmp_dir, 'job%d.out' % i)) as f:
+                pids.add(int(f.read()))
+        self.assertEqual(pids, set(proc.pid for proc in self.workers))
+
+        # the workers stop when idle
+        for proc in self.workers:
+            self.assertEqual(proc.wait(), 0)
+        self.assertEqual(self.queue.workers(), [])
+
+    def test_failed_after_max_tries(self):
+        job_id = self.queue.submit(self._script('failing', 'exit 3\n'), max_tries=2)
+        worker = jobqueue.Worker(self.queue, idle_timeout=0)
+        worker.run()
+
+        status, error = self.queue.status(job_id)
+        self.assertEqual(status, 'failed')
+        self.assertTrue('exit code 3' in error)
+
+    def test_lost_worker(self):
+        job_id = self.queue.submit(self._script('lost', 'exit 0\n'))
+        self.queue.register_worker('lost')
+        self.assertEqual(self.queue.claim('lost')[0], job_id)
+
+        # the heartbeats come from a host, whose clock is way ahead
+        skewed = time.time() + 3600
+        self.queue._execute("update jobs set heartbeat = ?", (skewed,))
+        self.queue._execute("update workers set heartbeat = ?", (skewed,))
+
+        observer = jobqueue.JobQueue(self.queue.fname)
+        observer.requeue_stale(timeout=0.5)
+        self.assertEqual(observer.status(job_id)[0], 'running')
+        time.sleep(0.6)
+        observer.requeue_stale(timeout=0.5)
+        self.assertEqual(observer.status(job_id), ('pending', 'worker lost'))
+        self.assertEqual(observer.workers(), [])
+
+        # another worker picks the job up again
+        jobqueue.Worker(self.queue, idle_timeout=0).run()
+        self.assertEqual(self.queue.status(job_id)[0], 'done')
+
+    def test_alive_worker_behind_in_time(self):
+        job_id = self.queue.submit(self._script('alive', 'exit 0\n'))
+        self.queue.register_worker('alive')
+        self.queue.claim('alive')
+
+        # the heartbeats come from a host, whose clock is way behind
+        observer = jobqueue.JobQueue(self.queue.fname)
+        skewed = time.time() - 3600
+        for i in range(3):
+            skewed += jobqueue.heartbeat_interval
+            self.queue._execute("update jobs set heartbeat = ?", (skewed,))
+            observer.requeue_stale(timeout=0.5)
+            time.sleep(0.3)
+        self.assertEqual(observer.status(job_id)[0], 'running')
+
+
+if __name__ == '__main__':
+    unittest.main()
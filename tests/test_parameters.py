@@ -0,0 +1,54 @@
+"""Tests of the parameter updates of the units. They need nipype and
+earlpipeline, and are skipped without them"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import nipype_wrapper_interfaces as interfaces
+except ImportError:
+    interfaces = None
+
+
+@unittest.skipIf(interfaces is None, 'needs nipype and earlpipeline')
+class SetParametersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ppl = interfaces.Pipeline('params', base_dir=self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_failed_update_restores_datasink_slot(self):
+        src = interfaces.PrimitiveSource()
+        sink = interfaces.DataSink5()
+        self.ppl.add_unit(src, 'src')
+        self.ppl.add_unit(sink, 'sink')
+        sink.set_parameter('slot_0_in', 'results.@first')
+        self.ppl.connect('src', 'str_par', 'sink', 'slot_0')
+
+        # fails after the slot has been redirected
+        after_set_parameters = sink._after_set_parameters
+        def failing(values):
+            after_set_parameters(values)
+            raise ValueError('failed halfway')
+        sink._after_set_parameters = failing
+
+        self.assertRaises(ValueError, sink.set_parameters,
+                {'slot_0_in': 'results.@second', 'link_mode': 'hardlink'})
+
+        self.assertEqual(sink.get_parameter('slot_0_in'), 'results.@first')
+        self.assertEqual(sink.get_parameter('link_mode'), 'copy')
+        self.assertEqual(sink.get_redirection('in', 'slot_0'), 'results.@first')
+        connections = self.ppl._workflow._graph.get_edge_data(src._node, sink._node)['connect']
+        self.assertEqual(connections, [('str_par', 'results.@first')])
+
+
+if __name__ == '__main__':
+    unittest.main()